@@ -1,11 +1,13 @@
 from __future__ import division
 import numpy as np
-from scipy.ndimage import gaussian_filter, gaussian_laplace
+from scipy.ndimage import gaussian_filter, gaussian_laplace, maximum_filter, label, find_objects
 import math
+import itertools
 from math import sqrt, log
 from scipy import spatial
 from skimage.util import img_as_float
 from skimage.feature.peak import peak_local_max
+from skimage.morphology import watershed
 
 
 # code from
@@ -127,6 +129,46 @@ def _blob_overlap(blob1, blob2):
         return _compute_sphere_overlap(d, r1, r2)
 
 
+def _blob_overlaps(blobs1, blobs2):
+    """Vectorised ``_blob_overlap`` of the blobs in the rows of two arrays.
+
+    Parameters
+    ----------
+    blobs1, blobs2 : (n, ndim + 1) ndarrays
+        Pairs of blobs ``(row, col, sigma)`` or ``(pln, row, col, sigma)``.
+
+    Returns
+    -------
+    f : (n,) ndarray
+        Fraction of overlapped area (or volume in 3D) of every pair.
+    """
+    n_dim = blobs1.shape[1] - 1
+    root_ndim = sqrt(n_dim)
+    r1 = blobs1[:, -1] * root_ndim
+    r2 = blobs2[:, -1] * root_ndim
+    d = np.sqrt(np.sum((blobs1[:, :-1] - blobs2[:, :-1]) ** 2, axis=1))
+
+    f = np.zeros(len(d))
+    inside = d <= np.abs(r1 - r2)
+    f[inside] = 1
+    partial = (d <= r1 + r2) & ~inside
+    d, r1, r2 = d[partial], r1[partial], r2[partial]
+    if n_dim == 2:
+        acos1 = np.arccos(np.clip((d ** 2 + r1 ** 2 - r2 ** 2) / (2 * d * r1), -1, 1))
+        acos2 = np.arccos(np.clip((d ** 2 + r2 ** 2 - r1 ** 2) / (2 * d * r2), -1, 1))
+        a = -d + r2 + r1
+        b = d - r2 + r1
+        c = d + r2 - r1
+        e = d + r2 + r1
+        area = r1 ** 2 * acos1 + r2 ** 2 * acos2 - 0.5 * np.sqrt(np.abs(a * b * c * e))
+        f[partial] = area / (math.pi * np.minimum(r1, r2) ** 2)
+    else:
+        vol = (math.pi / (12 * d) * (r1 + r2 - d) ** 2 *
+               (d ** 2 + 2 * d * (r1 + r2) - 3 * (r1 ** 2 + r2 ** 2) + 6 * r1 * r2))
+        f[partial] = vol / (4. / 3 * math.pi * np.minimum(r1, r2) ** 3)
+    return f
+
+
 def _prune_blobs(blobs_array, overlap):
     """Eliminated blobs with area overlap.
 
@@ -162,16 +204,20 @@ def _prune_blobs(blobs_array, overlap):
         pairs = np.array(list(tree.query_pairs(distance)))
     if len(pairs) == 0:
         return blobs_array
-    else:
-        for (i, j) in pairs:
-            blob1, blob2 = blobs_array[i], blobs_array[j]
-            if _blob_overlap(blob1, blob2) > overlap:
-                if blob1[-1] > blob2[-1]:
-                    blob2[-1] = 0
-                else:
-                    blob1[-1] = 0
 
-    return np.array([b for b in blobs_array if b[-1] > 0])
+    # the overlaps of all pairs within (r1 + r2) are computed at once, only the pairs
+    # that overlap enough are visited in the order of the tree, a blob that was
+    # eliminated before can not eliminate another one anymore
+    pairs = pairs[_blob_overlaps(blobs_array[pairs[:, 0]], blobs_array[pairs[:, 1]]) > overlap]
+    sigmas = blobs_array[:, -1]
+    for i, j in pairs.tolist():
+        if sigmas[i] > 0 and sigmas[j] > 0:
+            if sigmas[i] > sigmas[j]:
+                sigmas[j] = 0
+            else:
+                sigmas[i] = 0
+
+    return blobs_array[sigmas > 0]
 
 
 def blob_dog(image, min_sigma=1, max_sigma=50, sigma_ratio=1.6, threshold=2.0,
@@ -251,7 +297,7 @@ def blob_dog(image, min_sigma=1, max_sigma=50, sigma_ratio=1.6, threshold=2.0,
     The radius of each blob is approximately :math:`\sqrt{2}sigma` for
     a 2-D image and :math:`\sqrt{3}sigma` for a 3-D image.
     """
-    image = img_as_float(image)
+    image = np.asarray(img_as_float(image), dtype='float32')
 
     # k such that min_sigma*(sigma_ratio**k) > max_sigma
     k = int(log(float(max_sigma) / min_sigma, sigma_ratio)) + 1
@@ -260,25 +306,7 @@ def blob_dog(image, min_sigma=1, max_sigma=50, sigma_ratio=1.6, threshold=2.0,
     sigma_list = np.array([min_sigma * (sigma_ratio ** i)
                            for i in range(k + 1)])
 
-    gaussian_images = [gaussian_filter(image, s) for s in sigma_list]
-
-    # computing difference between two successive Gaussian blurred images
-    # multiplying with standard deviation provides scale invariance
-    dog_images = [(gaussian_images[i] - gaussian_images[i + 1])
-                  * sigma_list[i] for i in range(k)]
-
-    # Replace by image_cube = np.stack(hessian_images, axis=-1)
-    # When we upgrade minimal requirements to NumPy 1.10
-    sl = (slice(None),) * image.ndim + (np.newaxis,)
-    arrays = [np.asanyarray(arr) for arr in dog_images]
-    extended_arrays = [arr[sl] for arr in arrays]
-    image_cube = np.concatenate(extended_arrays, axis=-1)
-
-    # local_maxima = get_local_maxima(image_cube, threshold)
-    local_maxima = peak_local_max(image_cube, threshold_abs=threshold,
-                                  footprint=np.ones((3,) * (image.ndim + 1)),
-                                  threshold_rel=0.0,
-                                  exclude_border=False)
+    local_maxima = _scale_space_peaks(_dog_scale_space(image, sigma_list), threshold)
     # Convert local_maxima to float64
     lm = local_maxima.astype(np.float64)
     # Convert the last index to its corresponding scale value
@@ -286,6 +314,122 @@ def blob_dog(image, min_sigma=1, max_sigma=50, sigma_ratio=1.6, threshold=2.0,
     return _prune_blobs(lm, overlap)
 
 
+def _dog_scale_space(image, sigma_list):
+    """Generates the difference of Gaussian levels of an image one by one.
+
+    Every Gaussian blurred image is blurred from the previous one with the
+    standard deviation ``sqrt(sigma_i ** 2 - sigma_(i-1) ** 2)``, so only two
+    blurred images are kept in memory at a time.
+
+    Parameters
+    ----------
+    image : float32 ndarray
+        Input grayscale image.
+    sigma_list : ndarray
+        Increasing standard deviations of the Gaussian kernels.
+
+    Yields
+    ------
+    dog : ndarray
+        ``(gaussian(sigma_i) - gaussian(sigma_(i+1))) * sigma_i``, multiplying
+        with the standard deviation provides scale invariance.
+    """
+    gaussian_image = gaussian_filter(image, sigma_list[0])
+    for i in range(len(sigma_list) - 1):
+        next_gaussian_image = gaussian_filter(gaussian_image, sqrt(sigma_list[i + 1] ** 2 - sigma_list[i] ** 2))
+        # the blurred image is not needed anymore, its memory is reused for the dog level
+        dog_image = gaussian_image
+        dog_image -= next_gaussian_image
+        dog_image *= sigma_list[i]
+        yield dog_image
+        gaussian_image = next_gaussian_image
+
+
+def _window_max(image, coordinates):
+    """Maximum of an image over the ``(3,) * ndim`` window of each coordinate.
+
+    Equals ``maximum_filter(image, size=3, mode='constant')`` at the
+    coordinates, without filtering the whole image.
+    """
+    window_max = np.full(len(coordinates), -np.inf, dtype=image.dtype)
+    values = np.empty(len(coordinates), dtype=image.dtype)
+    for offset in itertools.product((-1, 0, 1), repeat=image.ndim):
+        shifted = coordinates + offset
+        inside = np.all((shifted >= 0) & (shifted < image.shape), axis=1)
+        # outside the image the filter is padded with 0
+        values.fill(0)
+        values[inside] = image[tuple(shifted[inside].T)]
+        np.maximum(window_max, values, out=window_max)
+    return window_max
+
+
+def _scale_space_peaks(dog_images, threshold):
+    """Finds the local maxima of a scale space level by level.
+
+    Gives the same peaks, in the same order, as ``peak_local_max`` on the
+    stacked scale space cube with a ``(3,) * (ndim + 1)`` footprint,
+    ``threshold_rel=0`` and ``exclude_border=False``, while only three
+    levels and the spatial maximum filter of one of them are kept in
+    memory at a time.
+
+    Parameters
+    ----------
+    dog_images : iterable of ndarrays
+        The levels of the scale space, from fine to coarse.
+    threshold : float
+        The absolute lower bound for scale space maxima.
+
+    Returns
+    -------
+    coordinates : (n, ndim + 1) ndarray
+        Coordinates of the maxima, the last column is the index of the level.
+    """
+    # peak_local_max also thresholds with threshold_rel * max, which is 0
+    threshold = max(threshold, 0.)
+    window = []
+    peaks = []
+    value_range = [np.inf, -np.inf]
+
+    def detect(level, previous, current, next):
+        # spatial maxima of the level first, these are few, so the neighbouring levels
+        # are only compared at their coordinates
+        mask = current > threshold
+        mask &= current == maximum_filter(current, size=3, mode='constant')
+        coordinates = np.argwhere(mask)
+        del mask
+        values = current[tuple(coordinates.T)]
+        is_peak = np.ones(len(coordinates), dtype=bool)
+        # beyond the first and last level the cube is padded with 0, which the
+        # values above the threshold already exceed
+        for neighbour in (previous, next):
+            if neighbour is not None:
+                is_peak &= values >= _window_max(neighbour, coordinates)
+        coordinates = coordinates[is_peak]
+        peaks.append(np.column_stack((coordinates, np.full(len(coordinates), level, dtype=coordinates.dtype))))
+
+    for dog_image in dog_images:
+        value_range[0] = min(value_range[0], dog_image.min())
+        value_range[1] = max(value_range[1], dog_image.max())
+        window.append(dog_image)
+        if len(window) == 2:
+            detect(0, None, window[0], window[1])
+        elif len(window) == 3:
+            detect(len(peaks), window[0], window[1], window[2])
+            del window[0]
+    if len(window) == 1:
+        detect(0, None, window[0], None)
+    elif window:
+        detect(len(peaks), window[0], window[1], None)
+
+    # a flat scale space has no peaks
+    if not peaks or value_range[0] == value_range[1]:
+        return np.empty((0, 2), dtype=np.int64)
+    coordinates = np.concatenate(peaks)
+    # peak_local_max returns the peaks in reversed C order of the cube
+    order = np.lexsort(coordinates.T[::-1])
+    return coordinates[order[::-1]]
+
+
 def blob_log(image, min_sigma=1, max_sigma=50, num_sigma=10, threshold=.2,
              overlap=.5, log_scale=False):
     """Finds blobs in the given grayscale image.
@@ -391,3 +535,93 @@ def blob_log(image, min_sigma=1, max_sigma=50, num_sigma=10, threshold=.2,
     # Convert the last index to its corresponding scale value
     lm[:, -1] = sigma_list[local_maxima[:, -1]]
     return _prune_blobs(lm, overlap)
+
+
+def _split_components(image, labels, n_labels, split_size, min_distance):
+    """Splits the components of more than ``split_size`` voxels by a
+    watershed from their local maxima, which are at least ``min_distance``
+    voxels apart. Plateaus of equal maxima count as one maximum.
+    """
+    sizes = np.bincount(labels.ravel(), minlength=n_labels + 1)
+    structure = np.ones((3,) * image.ndim)
+    for i, bbox in enumerate(find_objects(labels)):
+        if bbox is None or sizes[i + 1] <= split_size:
+            continue
+        component = labels[bbox] == i + 1
+        component_image = np.where(component, image[bbox], 0)
+        peaks = component & (component_image == maximum_filter(component_image, size=2 * min_distance + 1))
+        markers, n_markers = label(peaks, structure=structure)
+        if n_markers < 2:
+            continue
+        parts = watershed(-component_image, markers, mask=component)
+        # the first part keeps the label of the component, the others get new ones
+        parts_labels = np.append([0, i + 1], n_labels + np.arange(1, n_markers))
+        labels[bbox][component] = parts_labels[parts[component]]
+        n_labels += n_markers - 1
+    return labels, n_labels
+
+
+def blob_components(image, threshold=.5, min_size=1, split_size=1000, min_distance=5,
+                    return_stats=False):
+    """Finds blobs as the connected components of a probability map.
+
+    The map is thresholded and labelled with full connectivity. Components
+    larger than ``split_size`` voxels are split at their local maxima, so
+    touching nodules give separate blobs. Every component gives one blob at
+    its probability weighted centre of mass, with the sigma of a sphere of
+    the same volume, so the output can replace the one of ``blob_dog``.
+
+    Parameters
+    ----------
+    image : 2D or 3D ndarray
+        Probability map.
+    threshold : float, optional
+        Voxels above threshold belong to the components.
+    min_size : int, optional
+        Components of fewer voxels are dropped.
+    split_size : int, optional
+        Components of more voxels are split, None never splits.
+    min_distance : int, optional
+        Minimum distance in voxels between the maxima a component is split at.
+    return_stats : bool, optional
+        Also return the statistics of the components.
+
+    Returns
+    -------
+    A : (n, image.ndim + 1) ndarray
+        ``(r, c, sigma)`` or ``(p, r, c, sigma)`` per component, the radius
+        of a blob is :math:`\sqrt{2}sigma` or :math:`\sqrt{3}sigma` like
+        for ``blob_dog``.
+    stats : dict of (n,) ndarrays, only if ``return_stats``
+        ``size`` in voxels, ``diameter`` of the sphere (or disk) of the same
+        volume, ``peak`` and ``mean`` probability.
+    """
+    image = np.asarray(image, dtype='float32')
+    labels, n_labels = label(image > threshold, structure=np.ones((3,) * image.ndim))
+    if split_size is not None and n_labels > 0:
+        labels, n_labels = _split_components(image, labels, n_labels, split_size, min_distance)
+
+    # all statistics from one pass over the component voxels
+    voxels = np.flatnonzero(labels)
+    voxel_labels = labels.ravel()[voxels]
+    probabilities = image.ravel()[voxels].astype(np.float64)
+    sizes = np.bincount(voxel_labels, minlength=n_labels + 1)[1:]
+    weights = np.bincount(voxel_labels, probabilities, minlength=n_labels + 1)[1:]
+    centers = np.empty((n_labels, image.ndim))
+    for axis, coordinates in enumerate(np.unravel_index(voxels, image.shape)):
+        centers[:, axis] = np.bincount(voxel_labels, probabilities * coordinates,
+                                       minlength=n_labels + 1)[1:]
+    peaks = np.zeros(n_labels + 1)
+    np.maximum.at(peaks, voxel_labels, probabilities)
+
+    keep = sizes >= max(min_size, 1)
+    sizes, weights, centers, peaks = sizes[keep], weights[keep], centers[keep], peaks[1:][keep]
+    centers /= weights[:, None]
+    if image.ndim == 3:
+        diameters = 2 * (3 * sizes / (4 * math.pi)) ** (1 / 3)
+    else:
+        diameters = 2 * np.sqrt(sizes / math.pi)
+    blobs = np.column_stack((centers, diameters / 2 / sqrt(image.ndim)))
+    if return_stats:
+        return blobs, {'size': sizes, 'diameter': diameters, 'peak': peaks, 'mean': weights / sizes}
+    return blobs
@@ -1,6 +1,8 @@
 import multiprocessing as mp
 import Queue
 import threading
+import traceback
+import numpy as np
 
 
 def buffered_gen_mp(source_gen, buffer_size=2):
@@ -54,3 +56,172 @@ def buffered_gen_threaded(source_gen, buffer_size=5):
 
     for data in iter(buffer.get, None):
         yield data
+
+
+def _batch_layout(batch, slot_nbytes, alignment=64):
+    """
+    Splits a batch into the arrays that fit one after the other in a slot and everything else.
+    :return: list of ('shm', offset, shape, dtype) for arrays in the slot and ('obj', item) for the rest
+    """
+    items = batch if isinstance(batch, tuple) else (batch,)
+    layout, offset = [], 0
+    for item in items:
+        if isinstance(item, np.ndarray) and offset + item.nbytes <= slot_nbytes:
+            layout.append(('shm', offset, item.shape, item.dtype.str))
+            offset += (item.nbytes + alignment - 1) // alignment * alignment
+        else:
+            layout.append(('obj', item))
+    return layout
+
+
+def _pool_worker_process(gen_fun, worker_id, n_workers, slots, free_slots, ready):
+    try:
+        for batch_idx, batch in enumerate(gen_fun(worker_id, n_workers)):
+            slot_id = free_slots.get()
+            slot = np.frombuffer(slots[slot_id], dtype='uint8')
+            layout = _batch_layout(batch, len(slot))
+            items = batch if isinstance(batch, tuple) else (batch,)
+            for item, entry in zip(items, layout):
+                if entry[0] == 'shm':
+                    _, offset, shape, dtype = entry
+                    slot[offset:offset + item.nbytes].view(dtype).reshape(shape)[...] = item
+            ready.put(('batch', worker_id, (batch_idx * n_workers + worker_id, slot_id, layout,
+                                            isinstance(batch, tuple))))
+        ready.put(('done', worker_id, None))
+    except Exception:
+        ready.put(('error', worker_id, traceback.format_exc()))
+
+
+def _probe_process(gen_fun, n_workers, ready):
+    try:
+        batch = next(gen_fun(0, n_workers))
+        items = batch if isinstance(batch, tuple) else (batch,)
+        ready.put(('size', 0, sum(x.nbytes + 64 for x in items if isinstance(x, np.ndarray))))
+    except Exception:
+        ready.put(('error', 0, traceback.format_exc()))
+
+
+def _get_message(ready, processes, finished, timeout=1.):
+    """
+    Waits for the next message of the workers and raises when a worker that did not
+    finish died without one, e.g. killed by a signal or the OOM killer.
+    :param finished: ids of the workers that are not expected to send messages anymore
+    """
+    while True:
+        try:
+            return ready.get(timeout=timeout)
+        except Queue.Empty:
+            for worker_id, process in enumerate(processes):
+                # a worker that sent its last message exits with code 0
+                if worker_id not in finished and process.exitcode not in (None, 0):
+                    raise RuntimeError('buffering worker %d died with exit code %d' % (worker_id, process.exitcode))
+
+
+def probe_slot_nbytes(gen_fun, n_workers):
+    """
+    Size of the shared memory slots of buffered_gen_pool from the first batch of worker 0.
+    The batch is made in a separate process, so the parent never creates state
+    (e.g. thread pools) in the generator that forked workers would inherit.
+    """
+    ready = mp.Queue()
+    process = mp.Process(target=_probe_process, args=(gen_fun, n_workers, ready))
+    process.daemon = True
+    process.start()
+    try:
+        kind, _, payload = _get_message(ready, [process], set())
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+    if kind == 'error':
+        raise RuntimeError('buffering probe failed:\n%s' % payload)
+    return payload
+
+
+def buffered_gen_pool(gen_fun, n_workers, slot_nbytes=None, slots_per_worker=2, ordered=True):
+    """
+    Generator that runs n_workers copies of a source generator in separate processes.
+    Worker w yields batches w, w + n_workers, w + 2 * n_workers, ... of the stream, so
+    gen_fun(w, n_workers) should produce a disjoint, deterministic slice of the samples.
+    Arrays of the batches are written into a ring of preallocated shared memory slots and
+    yielded as views on them, without pickling or copying. A view is only valid until the
+    next batch is requested, copy it if it has to live longer.
+    Arrays that do not fit in the remaining space of a slot, and all other items of
+    the batch tuple, are sent through a queue instead.
+    A worker that dies without a message, e.g. killed by the OOM killer, raises a RuntimeError.
+    :param gen_fun: gen_fun(worker_id, n_workers) creates the generator of a worker
+    :param slot_nbytes: size of one slot, at least the total size of the arrays of a batch,
+                        None to take it from a first batch made in a separate process
+    :param slots_per_worker: number of batches a worker can produce ahead
+    :param ordered: yield the batches in stream order, otherwise as soon as they are ready
+    """
+    if slots_per_worker < 1:
+        raise RuntimeError("Minimal number of slots per worker is 1!")
+    if slot_nbytes is None:
+        slot_nbytes = probe_slot_nbytes(gen_fun, n_workers)
+
+    # every worker has its own slots, so a worker whose batch is next in line can
+    # never be blocked by batches of other workers that wait for it
+    slots = [mp.RawArray('b', slot_nbytes) for _ in xrange(n_workers * slots_per_worker)]
+    free_slots = [mp.Queue() for _ in xrange(n_workers)]
+    for slot_id in xrange(len(slots)):
+        free_slots[slot_id // slots_per_worker].put(slot_id)
+    ready = mp.Queue()
+
+    processes = []
+    for worker_id in xrange(n_workers):
+        process = mp.Process(target=_pool_worker_process,
+                             args=(gen_fun, worker_id, n_workers, slots, free_slots[worker_id], ready))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+
+    pending = {}
+    done_workers = set()
+    next_idx = 0
+    try:
+        while True:
+            if ordered:
+                # a finished worker has no more batches in line, skip its turns
+                while next_idx not in pending and next_idx % n_workers in done_workers and pending:
+                    next_idx += 1
+                if next_idx in pending:
+                    message = pending.pop(next_idx)
+                    next_idx += 1
+                elif len(done_workers) == n_workers:
+                    break
+                else:
+                    message = None
+            else:
+                message = pending.popitem()[1] if pending else None
+                if message is None and len(done_workers) == n_workers:
+                    break
+
+            if message is None:
+                kind, worker_id, payload = _get_message(ready, processes, done_workers)
+                if kind == 'error':
+                    raise RuntimeError('buffering worker %d failed:\n%s' % (worker_id, payload))
+                if kind == 'done':
+                    done_workers.add(worker_id)
+                else:
+                    batch_idx, slot_id, layout, is_tuple = payload
+                    pending[batch_idx] = (worker_id, slot_id, layout, is_tuple)
+                continue
+
+            worker_id, slot_id, layout, is_tuple = message
+            slot = np.frombuffer(slots[slot_id], dtype='uint8')
+            items = []
+            for entry in layout:
+                if entry[0] == 'shm':
+                    _, offset, shape, dtype = entry
+                    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                    items.append(slot[offset:offset + nbytes].view(dtype).reshape(shape))
+                else:
+                    items.append(entry[1])
+            yield tuple(items) if is_tuple else items[0]
+            free_slots[worker_id].put(slot_id)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
@@ -0,0 +1,225 @@
+import multiprocessing as mp
+import Queue
+import time
+import traceback
+import numpy as np
+import blobs_detection
+
+
+def _extraction_worker_process(worker_idx, extract_fun, slots, tasks, results, current_tasks):
+    for task_id, key, slot_id, heatmap, args, submit_time in iter(tasks.get, None):
+        # written to shared memory right away, so the parent knows the task if this worker dies
+        current_tasks[worker_idx] = task_id
+        start_time = time.time()
+        error = None
+        try:
+            if slot_id is not None:
+                shape, dtype = heatmap
+                heatmap = np.frombuffer(slots[slot_id], dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+            extract_fun(heatmap, *args)
+        except Exception:
+            error = traceback.format_exc()
+        # the slot is returned by the parent when it takes the result, and the task is only
+        # cleared once the result is sent, so a task is never lost between the two
+        results.put((task_id, start_time - submit_time, time.time() - start_time, error))
+        current_tasks[worker_idx] = -1
+
+
+class ExtractionPool(object):
+    """
+    Long-lived pool of candidate extraction workers. Heatmaps are handed over in preallocated
+    shared memory slots: the prediction loop asks for a free slot, writes the heatmap straight
+    into it and submits it, and the slot is free again once the result of the heatmap is in.
+    The number of slots follows from a memory budget, so the memory of the queued heatmaps is
+    bounded and the prediction loop only waits when the whole budget is in use.
+    Heatmaps that do not fit in a slot are passed to the workers through the queue.
+    A worker that dies, e.g. killed by the OOM killer, loses its heatmap like a failed
+    extraction: its slot is reclaimed and a new worker takes its place.
+    """
+
+    def __init__(self, extract_fun, n_workers, slot_shape, memory_budget, dtype='float32'):
+        """
+        :param extract_fun: extract_fun(heatmap, *args) runs in the workers
+        :param slot_shape: shape of the largest heatmap that fits in a slot
+        :param memory_budget: bytes of all slots together, at least one slot is made
+        """
+        self.extract_fun = extract_fun
+        self.dtype = np.dtype(dtype)
+        self.slot_nbytes = int(np.prod(slot_shape)) * self.dtype.itemsize
+        self.n_slots = max(1, int(memory_budget // self.slot_nbytes))
+        self.slots = [mp.RawArray('b', self.slot_nbytes) for _ in xrange(self.n_slots)]
+        # only the parent hands out and returns slots
+        self.free_slots = range(self.n_slots)
+        self.tasks = mp.Queue()
+        self.results = mp.Queue()
+        # task id -> (key, slot id) of the submitted heatmaps without result
+        self.pending = {}
+        self.n_submitted = 0
+        # task id every worker is busy with, -1 when idle
+        self.current_tasks = mp.RawArray('l', [-1] * n_workers)
+        self.n_died = 0
+        self.was_idle = False
+
+        self.processes = [None] * n_workers
+        for worker_idx in xrange(n_workers):
+            self._start_worker(worker_idx)
+
+    def _start_worker(self, worker_idx):
+        self.current_tasks[worker_idx] = -1
+        process = mp.Process(target=_extraction_worker_process,
+                             args=(worker_idx, self.extract_fun, self.slots, self.tasks,
+                                   self.results, self.current_tasks))
+        process.daemon = True
+        process.start()
+        self.processes[worker_idx] = process
+
+    def _finish(self, task_id):
+        """
+        :return: key of the pending task, its slot is free again, None when it was finished already
+        """
+        if task_id not in self.pending:
+            return None
+        key, slot_id = self.pending.pop(task_id)
+        if slot_id is not None:
+            self.free_slots.append(slot_id)
+        return key
+
+    def check_workers(self):
+        """
+        Replaces the workers that died, the heatmap a dead worker was busy with is reported
+        as failed and its slot is returned.
+        """
+        for worker_idx, process in enumerate(self.processes):
+            if process.exitcode is None:
+                continue
+            self.n_died += 1
+            key = self._finish(self.current_tasks[worker_idx])
+            if key is not None:
+                print 'candidate extraction of %s failed: worker died with exit code %d' % (key, process.exitcode)
+            else:
+                print 'candidate extraction worker died with exit code %d' % process.exitcode
+            self._start_worker(worker_idx)
+
+    def drop_lost_tasks(self):
+        """
+        A worker killed right after taking a task, or before its result was sent, leaves the
+        task pending without any worker busy with it. Once a worker died and the workers were
+        idle with an empty task queue at two checks in a row, the pending heatmaps are reported
+        as failed.
+        """
+        idle = self.n_died > 0 and self.tasks.empty() and all(task_id == -1 for task_id in self.current_tasks)
+        if idle and self.was_idle:
+            for task_id in sorted(self.pending):
+                print 'candidate extraction of %s failed: lost by a worker that died' % self._finish(task_id)
+        self.was_idle = idle
+
+    def wait(self):
+        """
+        Waits up to a second for a result and handles it, otherwise checks the workers.
+        :return: False when the wait timed out
+        """
+        try:
+            task_id, wait_time, extraction_time, error = self.results.get(timeout=1.)
+        except Queue.Empty:
+            self.check_workers()
+            self.drop_lost_tasks()
+            return False
+        self.was_idle = False
+        self.handle_result(task_id, wait_time, extraction_time, error)
+        return True
+
+    def handle_result(self, task_id, wait_time, extraction_time, error):
+        # a worker that died after sending its result may have been reported already
+        key = self._finish(task_id)
+        if key is None:
+            return
+        if error is not None:
+            print 'candidate extraction of %s failed:\n%s' % (key, error)
+        else:
+            print 'candidates of %s: queue wait %.1f s, extraction %.1f s' % (key, wait_time, extraction_time)
+
+    def acquire(self, shape):
+        """
+        Blocks until a slot is free.
+        :return: slot id, zeroed heatmap array of the given shape in the slot,
+                 or None and a new array when it does not fit in a slot
+        """
+        if int(np.prod(shape)) * self.dtype.itemsize > self.slot_nbytes:
+            return None, np.zeros(shape, dtype=self.dtype)
+        start_time = time.time()
+        self.report(block=False)
+        while not self.free_slots:
+            self.wait()
+        slot_id = self.free_slots.pop(0)
+        wait_time = time.time() - start_time
+        if wait_time > 1.:
+            print 'waited %.1f s for a free heatmap slot' % wait_time
+        heatmap = np.frombuffer(self.slots[slot_id], dtype=self.dtype, count=int(np.prod(shape))).reshape(shape)
+        heatmap[...] = 0
+        return slot_id, heatmap
+
+    def submit(self, key, slot_id, heatmap, *args):
+        """
+        :param key: name of the heatmap in the timing report, e.g. the patient id
+        :param slot_id: slot id returned by acquire, the heatmap must not be used anymore afterwards
+        """
+        if slot_id is not None:
+            heatmap = (heatmap.shape, self.dtype.str)
+        task_id = self.n_submitted
+        self.n_submitted += 1
+        self.pending[task_id] = (key, slot_id)
+        self.tasks.put((task_id, key, slot_id, heatmap, args, time.time()))
+        self.report(block=False)
+
+    def report(self, block=False):
+        """
+        Prints the queue wait and extraction times of the finished heatmaps.
+        :param block: wait until all submitted heatmaps are finished, failed or lost
+        """
+        while self.pending:
+            if block:
+                self.wait()
+                continue
+            try:
+                self.handle_result(*self.results.get(block=False))
+            except Queue.Empty:
+                return
+
+    def close(self):
+        """
+        Waits for all submitted heatmaps and stops the workers, the heatmaps of workers
+        that died are given up.
+        """
+        self.report(block=True)
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+
+def blobs_to_original(blobs, tf_matrix):
+    """
+    Maps blobs (z, y, x, sigma) in heatmap voxels to candidates (z, y, x, 1) in voxels of the original scan.
+    """
+    return np.asarray([tf_matrix.dot(np.append(blob[:3], [1])) for blob in blobs])
+
+
+BLOB_DETECTORS = ('dog', 'components')
+
+
+def detect_blobs(heatmap, detector='dog', threshold=None, min_sigma=1, max_sigma=15):
+    """
+    :param detector: 'dog' for blob_dog, 'components' for the connected components of the
+                     heatmap, which is much faster on probability maps
+    :param threshold: None for the default of the detector, a DoG response for 'dog'
+                      and a probability for 'components'
+    :param min_sigma: smallest blob sigma of 'dog'
+    :param max_sigma: largest blob sigma of 'dog'
+    :return: (n, 4) array of blobs (z, y, x, sigma) in heatmap voxels
+    """
+    if detector == 'dog':
+        return blobs_detection.blob_dog(heatmap, min_sigma=min_sigma, max_sigma=max_sigma,
+                                        threshold=0.1 if threshold is None else threshold)
+    if detector == 'components':
+        return blobs_detection.blob_components(heatmap, threshold=0.5 if threshold is None else threshold)
+    raise ValueError('blob detector should be one of %s' % (BLOB_DETECTORS,))
@@ -0,0 +1,172 @@
+import os
+import glob
+import struct
+import fcntl
+import numpy as np
+import utils
+
+MAGIC = 'CANDSTORE1'
+HEADER_SIZE = 64
+PID_SIZE = 80
+
+
+def store_path(predictions_path):
+    """
+    The store of a stage lives next to its model-predictions/<config> directory.
+    """
+    return predictions_path.rstrip('/') + '.candidates'
+
+
+class CandidateStore(object):
+    """
+    Candidates of all patients of one stage in a single append-only file of fixed size
+    records (pid, append id, candidate columns), indexed by pid -> row range when read.
+    Every patient is appended on a file opened with O_APPEND under an exclusive flock, so
+    parallel workers can append and the rows of a patient stay contiguous, also when a
+    write is short and has to be continued. Readers do not lock.
+    Appending a patient again replaces its candidates, the last rows win.
+    """
+
+    def __init__(self, path, n_columns=None):
+        """
+        :param n_columns: number of candidate columns, only needed to create a new store
+        """
+        self.path = path
+        if not os.path.isfile(path):
+            if n_columns is None:
+                raise IOError('no candidate store at %s' % path)
+            self._create(n_columns)
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE).split()
+        if len(header) != 2 or header[0] != MAGIC:
+            raise ValueError('%s is not a candidate store' % path)
+        self.n_columns = int(header[1])
+        if n_columns is not None and n_columns != self.n_columns:
+            raise ValueError('store has %d columns, got %d' % (self.n_columns, n_columns))
+        self.dtype = np.dtype([('pid', 'S%d' % PID_SIZE), ('append_id', 'int64'),
+                               ('candidate', 'float64', (self.n_columns,))])
+        self._size = None
+        self._rows = None
+        self._pid2range = {}
+
+    def _create(self, n_columns):
+        # write the header to a temporary file and link it in place, so concurrent
+        # creators never see or append to a store without header
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(('%s %d' % (MAGIC, n_columns)).ljust(HEADER_SIZE))
+        try:
+            os.link(tmp_path, self.path)
+        except OSError:
+            if not os.path.isfile(self.path):
+                raise
+        finally:
+            os.remove(tmp_path)
+
+    def append(self, pid, candidates):
+        candidates = np.asarray(candidates, dtype='float64').reshape(-1, self.n_columns)
+        if len(pid) > PID_SIZE:
+            raise ValueError('pid longer than %d characters: %s' % (PID_SIZE, pid))
+        # a patient without candidates is stored as one row of nans, so it is still known
+        if len(candidates) == 0:
+            candidates = np.full((1, self.n_columns), np.nan)
+        records = np.empty(len(candidates), dtype=self.dtype)
+        records['pid'] = pid
+        # tells apart two consecutive appends of the same patient
+        records['append_id'] = struct.unpack('q', os.urandom(8))[0]
+        records['candidate'] = candidates
+        data = records.tobytes()
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # os.write can write less than asked, e.g. when interrupted by a signal
+            n_written = 0
+            while n_written < len(data):
+                n_written += os.write(fd, data[n_written:])
+        finally:
+            os.close(fd)
+
+    def _refresh(self):
+        size = os.path.getsize(self.path)
+        if size == self._size:
+            return
+        # a record that is still being written by another worker is left out
+        n_rows = (size - HEADER_SIZE) // self.dtype.itemsize
+        if n_rows > 0:
+            self._rows = np.memmap(self.path, dtype=self.dtype, mode='r', offset=HEADER_SIZE, shape=(n_rows,))
+            pids = self._rows['pid']
+            append_ids = self._rows['append_id']
+            new_run = (pids[1:] != pids[:-1]) | (append_ids[1:] != append_ids[:-1])
+            starts = np.append(0, np.flatnonzero(new_run) + 1)
+            stops = np.append(starts[1:], n_rows)
+            self._pid2range = dict((str(pids[start]), (start, stop))
+                                   for start, stop in zip(starts.tolist(), stops.tolist()))
+        self._size = size
+
+    def __contains__(self, pid):
+        self._refresh()
+        return pid in self._pid2range
+
+    def pids(self):
+        self._refresh()
+        return sorted(self._pid2range.keys())
+
+    def read(self, pid, top_k=None):
+        """
+        :param top_k: only read the first top_k candidates, stages store them sorted by score
+        :return: (n, n_columns) array of candidates
+        """
+        self._refresh()
+        start, stop = self._pid2range[pid]
+        if top_k is not None:
+            stop = min(stop, start + top_k)
+        candidates = np.array(self._rows['candidate'][start:stop])
+        if len(candidates) == 1 and np.all(np.isnan(candidates)):
+            candidates = candidates[:0]
+        return candidates
+
+    def id2candidates(self):
+        return dict((pid, StoredCandidates(self, pid)) for pid in self.pids())
+
+    def import_pkl_dir(self, pkl_dir, skip_existing=True):
+        """
+        Imports the <pid>.pkl files of an existing model-predictions directory.
+        """
+        n_imported = 0
+        for path in sorted(glob.glob(pkl_dir + '/*.pkl')):
+            pid = os.path.basename(path)[:-len('.pkl')]
+            if skip_existing and pid in self:
+                continue
+            self.append(pid, utils.load_pkl(path))
+            n_imported += 1
+        return n_imported
+
+
+class StoredCandidates(object):
+    """
+    Handle to the candidates of one patient, the store counterpart of a <pid>.pkl path.
+    """
+
+    def __init__(self, store, pid):
+        self.store = store
+        self.pid = pid
+
+    def load(self, top_k=None):
+        return self.store.read(self.pid, top_k)
+
+    def __repr__(self):
+        return '%s[%s]' % (self.store.path, self.pid)
+
+
+def save_candidates(candidates, predictions_path, pid):
+    """
+    Saves the candidates of a patient as <pid>.pkl and appends them to the store of the stage.
+    """
+    utils.save_pkl(candidates, predictions_path + '/%s.pkl' % pid)
+    candidates = np.asarray(candidates)
+    n_columns = candidates.shape[-1] if candidates.ndim == 2 else None
+    path = store_path(predictions_path)
+    if n_columns is None and not os.path.isfile(path):
+        # the column count of the stage is not known yet
+        return
+    CandidateStore(path, n_columns).append(pid, candidates)
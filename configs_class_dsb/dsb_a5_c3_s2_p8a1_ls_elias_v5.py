@@ -34,6 +34,8 @@ n_candidates_per_patient = 4
 def data_prep_function(data, patch_centers, pixel_spacing, p_transform,
                        p_transform_augment, **kwargs):
     x = data_transforms.transform_dsb_candidates(data=data,
+                                                 out=kwargs.get('out'),
+                                                 random_state=kwargs.get('random_state'),
                                                  patch_centers=patch_centers,
                                                  p_transform=p_transform,
                                                  p_transform_augment=p_transform_augment,
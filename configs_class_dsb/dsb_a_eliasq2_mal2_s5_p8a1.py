@@ -47,6 +47,8 @@ rescale_params_hist_eq = utils.load_pkl( "dsb_rescale_params_hist_eq.pkl" )
 def data_prep_function(data, pid, patch_centers, pixel_spacing, p_transform,
                        p_transform_augment, **kwargs):
     x = data_transforms.transform_dsb_candidates(data=data,
+                                                 out=kwargs.get('out'),
+                                                 random_state=kwargs.get('random_state'),
                                                  patch_centers=patch_centers,
                                                  p_transform=p_transform,
                                                  p_transform_augment=p_transform_augment,
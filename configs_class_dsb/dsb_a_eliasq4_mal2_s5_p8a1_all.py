@@ -45,6 +45,8 @@ n_candidates_per_patient = 16
 def data_prep_function(data, patch_centers, pixel_spacing, p_transform,
                        p_transform_augment, **kwargs):
     x = data_transforms.transform_dsb_candidates(data=data,
+                                                 out=kwargs.get('out'),
+                                                 random_state=kwargs.get('random_state'),
                                                  patch_centers=patch_centers,
                                                  p_transform=p_transform,
                                                  p_transform_augment=p_transform_augment,
@@ -103,7 +105,10 @@ train_data_iterator = data_iterators.DSBPatientsDataGenerator(data_path=pathfind
                                                               id2label = id2label_all,
                                                               rng=rng,
                                                               patient_ids=all_pids,
-                                                              random=True, infinite=True)
+                                                              random=True, infinite=True,
+                                                              # only read the boxes around the candidates
+                                                              partial_read=True,
+                                                              p_transform_augment=p_transform_augment)
 
 valid_data_iterator = data_iterators.DSBPatientsDataGenerator(data_path=pathfinder.DATA_PATH,
                                                               batch_size=1,
@@ -115,7 +120,8 @@ valid_data_iterator = data_iterators.DSBPatientsDataGenerator(data_path=pathfind
                                                               id2label = id2label_all,
                                                               rng=rng,
                                                               patient_ids=valid_pids,
-                                                              random=False, infinite=False)
+                                                              random=False, infinite=False,
+                                                              partial_read=True)
 
 
 test_data_iterator = data_iterators.DSBPatientsDataGenerator(data_path=pathfinder.DATA_PATH,
@@ -128,7 +134,8 @@ test_data_iterator = data_iterators.DSBPatientsDataGenerator(data_path=pathfinde
                                                               id2label = id2label_all,
                                                               rng=rng,
                                                               patient_ids=stage2_pids,
-                                                              random=False, infinite=False)
+                                                              random=False, infinite=False,
+                                                              partial_read=True)
 
 
 tta_batch_size = 8
@@ -43,6 +43,7 @@ def data_prep_function(data, patch_center, pixel_spacing, luna_origin, p_transfo
                                                                patch_center=patch_center,
                                                                p_transform=p_transform,
                                                                p_transform_augment=p_transform_augment,
+                                                               random_state=kwargs.get('random_state'),
                                                                pixel_spacing=pixel_spacing,
                                                                luna_origin=luna_origin,
                                                                world_coord_system=world_coord_system)
@@ -36,6 +36,7 @@ def data_prep_function(data, patch_center, luna_annotations, pixel_spacing, luna
                                                                                patch_center=patch_center,
                                                                                p_transform=p_transform,
                                                                                p_transform_augment=p_transform_augment,
+                                                                               random_state=kwargs.get('random_state'),
                                                                                pixel_spacing=pixel_spacing,
                                                                                luna_origin=luna_origin)
     x = data_transforms.hu2normHU(x)
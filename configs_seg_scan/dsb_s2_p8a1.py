@@ -19,16 +19,32 @@ p_transform = {'patch_size': (416, 416, 416),
 window_size = 160
 stride = 128
 n_windows = (p_transform['patch_size'][0] - window_size) / stride + 1
+# crop the canvas to the lung bounding box plus canvas_margin voxels instead of the fixed patch_size
+adaptive_canvas = False
+canvas_margin = 16.
+# store the heatmaps as 'uint8' or 'float16' for extract_candidates.py, None does not store them
+heatmap_quantisation = None
+# 'dog' or 'components', the connected components of the heatmap are much faster to extract
+blob_detector = 'dog'
+# None takes the default threshold of the detector
+blob_threshold = None
+# device memory for the windows of one prediction batch, None predicts window by window
+window_batch_memory = 2 * 1024 ** 3
 
 
 def data_prep_function(data, pixel_spacing, p_transform=p_transform):
     # TODO: MAKE SURE THAT DATA IS PREPROCESSED THE SAME WAY
     lung_mask = lung_segmentation.segment_HU_scan(data)
+    canvas_center = None
+    if adaptive_canvas:
+        p_transform, canvas_center = data_transforms.lung_canvas(lung_mask, pixel_spacing, p_transform,
+                                                                 window_size, stride, canvas_margin)
     x, tf_matrix, lung_mask_out = data_transforms.transform_scan3d(data=data,
                                                                    pixel_spacing=pixel_spacing,
                                                                    p_transform=p_transform,
                                                                    lung_mask=lung_mask,
-                                                                   p_transform_augment=None)
+                                                                   p_transform_augment=None,
+                                                                   canvas_center=canvas_center)
     x = data_transforms.pixelnormHU(x)
     return x, lung_mask_out, tf_matrix
 
@@ -39,6 +39,8 @@ p_transform = {'patch_size': (416, 416, 416),
 window_size = 160
 stride = 128
 n_windows = (p_transform['patch_size'][0] - window_size) / stride + 1
+# device memory for the windows of one prediction batch, None predicts window by window
+window_batch_memory = 2 * 1024 ** 3
 
 valid_pids = patch_config.valid_pids
 
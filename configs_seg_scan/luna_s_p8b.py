@@ -18,6 +18,8 @@ p_transform = {'patch_size': (424, 424, 424),
 window_size = 160
 stride = 132
 n_windows = (p_transform['patch_size'][0] - window_size) / stride + 1
+# device memory for the windows of one prediction batch, None predicts window by window
+window_batch_memory = 2 * 1024 ** 3
 print window_size
 print stride
 print n_windows
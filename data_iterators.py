@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 # encoding: utf-8
+import os
 import numpy as np
 import utils_lung
 import pathfinder
 import utils
+import volume_store
+import volume_cache
+import data_transforms
+import buffering
 
 
 # 6% to 28% for nodules 5 to 10 mm,
@@ -42,6 +47,270 @@ def diameter_to_prob(diam):
     return np.clip(p ,0.,1.)
 
 
+_volume_store = None
+
+
+def get_volume_store():
+    global _volume_store
+    if _volume_store is None and pathfinder.VOLUME_STORE_PATH \
+            and os.path.isdir(pathfinder.VOLUME_STORE_PATH):
+        _volume_store = volume_store.VolumeStore(pathfinder.VOLUME_STORE_PATH)
+    return _volume_store
+
+
+_isotropic_store = None
+
+
+def get_isotropic_store():
+    global _isotropic_store
+    if _isotropic_store is None and pathfinder.ISOTROPIC_STORE_PATH \
+            and os.path.isdir(pathfinder.ISOTROPIC_STORE_PATH):
+        _isotropic_store = volume_store.VolumeStore(pathfinder.ISOTROPIC_STORE_PATH)
+    return _isotropic_store
+
+
+def read_dsb_scan_isotropic(patient_path, store=None):
+    """
+    Reads a DSB scan resampled by make_isotropic_store.py. Patients missing from
+    the store are read at their original spacing with an identity voxel_tf.
+    :return: volume, pixel_spacing, voxel_tf mapping voxels of the volume to voxels of the original scan
+    """
+    store = store or get_isotropic_store()
+    pid = utils_lung.extract_pid_dir(patient_path)
+    if store is not None and pid in store:
+        img, pixel_spacing = store.read_scan(pid)
+        return img, pixel_spacing, store.read_metadata(pid)['voxel_tf']
+    img, pixel_spacing = read_dsb_scan(patient_path)
+    return img, pixel_spacing, np.eye(4)
+
+
+# bytes of LUNA scans kept in memory by read_luna_scan in one process,
+# the workers of buffered_generate split it between them
+LUNA_SCAN_CACHE_BYTES = 4 * 1024 ** 3
+_scan_cache = None
+
+
+def get_scan_cache():
+    global _scan_cache
+    if _scan_cache is None:
+        _scan_cache = volume_cache.VolumeCache(LUNA_SCAN_CACHE_BYTES)
+    return _scan_cache
+
+
+def set_scan_cache_bytes(max_bytes):
+    """
+    Replaces the scan cache of this process by an empty one of max_bytes.
+    """
+    global _scan_cache
+    _scan_cache = volume_cache.VolumeCache(max_bytes)
+
+
+def read_luna_scan(patient_path, file_extension='.mhd', cache=None):
+    """
+    Reads a LUNA scan through the scan cache shared by all generators.
+    The returned arrays are read-only when they are cached.
+    :return: volume, origin, pixel_spacing
+    """
+    cache = cache or get_scan_cache()
+
+    def load():
+        return utils_lung.read_pkl(patient_path) if file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+
+    return cache.get(patient_path, load)
+
+
+def buffered_generate(data_iterator, n_workers=0, buffer_size=5, ordered=True, slot_nbytes=None):
+    """
+    Buffered data_iterator.generate() of the training scripts, switched by the n_data_workers
+    knob of a config. Without workers the generator runs in a thread, otherwise worker w of the
+    pool yields batches w, w + n_workers, ... of the iterator (see SampleStreams.owns), so the
+    workers cover disjoint parts of every epoch.
+    Seeded SampleStreams yield the same batches for any number of workers, with or without the
+    pool. Iterators without a seed get one drawn from their rng, the rng of the config, so
+    configs need not set one. Only iterators with a patient pool stay unseeded: all workers
+    shuffle with the same rng and draw their samples and augmentations from their own.
+    Only meant for the random, endless training iterators with SampleStreams.
+    :param slot_nbytes: bytes of the arrays of a batch, None to measure it on a first batch made
+                        in a separate process, so the parent does not run the iterator before forking
+    """
+    streams = getattr(data_iterator, 'streams', None)
+    if streams is not None and streams.seed is None and streams.seedable:
+        streams.seed = streams.rng.randint(0, 2 ** 31 - 1)
+
+    if not n_workers:
+        return buffering.buffered_gen_threaded(data_iterator.generate(), buffer_size)
+
+    if streams is None:
+        raise ValueError('%s has no SampleStreams, its batches cannot be split over workers'
+                         % type(data_iterator).__name__)
+    shuffle_seed = data_iterator.rng.randint(0, 2 ** 31 - 1)
+    seeds = data_iterator.rng.randint(0, 2 ** 31 - 1, size=(n_workers, 2))
+
+    def worker_generate(worker_id, n_workers):
+        set_scan_cache_bytes(LUNA_SCAN_CACHE_BYTES // n_workers)
+        streams.worker_id, streams.n_workers = worker_id, n_workers
+        if streams.seed is None:
+            streams.rng = np.random.RandomState(shuffle_seed)
+            streams.draw_rng = data_iterator.rng = np.random.RandomState(seeds[worker_id, 0])
+            data_transforms.rng = np.random.RandomState(seeds[worker_id, 1])
+        return data_iterator.generate()
+
+    return buffering.buffered_gen_pool(worker_generate, n_workers, slot_nbytes,
+                                       slots_per_worker=max(2, buffer_size // n_workers), ordered=ordered)
+
+
+_nodule_index = None
+
+
+def get_nodule_index():
+    global _nodule_index
+    if _nodule_index is None:
+        _nodule_index = utils_lung.LunaNoduleIndex(pathfinder.LUNA_NODULE_ANNOTATIONS_PATH)
+    return _nodule_index
+
+
+class PatientPool(object):
+    """
+    Locality-aware patient sampling for the patch generators. Patients enter a pool
+    of pool_size patients in a (shuffled) round robin order and each of them serves
+    patches_per_patient patches before the next patient takes its place. Every draw
+    picks a random member of the pool, so the pool acts as a mixing window and a scan
+    is loaded once per patches_per_patient patches instead of once per patch.
+    """
+
+    def __init__(self, keys, load_fun, pool_size, patches_per_patient, rng, random=True):
+        """
+        :param keys: patients to sample from, passed to load_fun
+        :param load_fun: maps a key to its scan, called once when the patient enters the pool
+        """
+        self.keys = list(keys)
+        self.load_fun = load_fun
+        self.pool_size = min(pool_size, len(self.keys))
+        self.patches_per_patient = patches_per_patient
+        self.rng = rng
+        self.random = random
+        self.pool = []
+        self.order = []
+        self.n_loads = 0
+
+    def next_key(self):
+        if not self.order:
+            self.order = range(len(self.keys))
+            if self.random:
+                self.rng.shuffle(self.order)
+            self.order.reverse()
+        return self.keys[self.order.pop()]
+
+    def draw(self):
+        """
+        :return: key, scan
+        """
+        while len(self.pool) < self.pool_size:
+            key = self.next_key()
+            self.pool.append([key, self.load_fun(key), self.patches_per_patient])
+            self.n_loads += 1
+        i = self.rng.randint(len(self.pool))
+        key, scan, n_left = self.pool[i]
+        if n_left > 1:
+            self.pool[i][2] -= 1
+        else:
+            del self.pool[i]
+        return key, scan
+
+
+class SampleStreams(object):
+    """
+    Random streams of a training iterator. Given a seed, the shuffle of an epoch and the
+    draws for every sample come from counter-based streams of (seed, epoch) and
+    (seed, epoch, sample, slot), where the sample is its position in the epoch. A batch then
+    no longer depends on the batches before it, so workers that each produce their own share
+    of the batches (see owns) give bit-identical batches for any number of workers.
+    Without a seed the shared rng of the iterator and the global augmentation rng are used;
+    buffered_generate gives the workers the same rng for the shuffles and their own draw_rng
+    for the samples, so their shares of the batches still cover the epoch without overlap.
+    """
+    SAMPLE_SLOT = 0
+    AUGMENTATION_SLOT = 1
+
+    def __init__(self, seed, rng, seedable=True):
+        """
+        :param seedable: False when the batches depend on earlier batches, e.g. with a patient
+                         pool, buffered_generate then leaves the streams unseeded
+        """
+        self.seed = seed
+        self.rng = rng
+        self.seedable = seedable
+        self.draw_rng = rng
+        self.worker_id = 0
+        self.n_workers = 1
+
+    def epoch(self, epoch):
+        return self.rng if self.seed is None else data_transforms.sample_rng(self.seed, epoch)
+
+    def sample(self, epoch, sample_idx):
+        """
+        :return: RandomState for the draws of the iterator itself, e.g. the choice of the patch
+        """
+        if self.seed is None:
+            return self.draw_rng
+        return data_transforms.sample_rng(self.seed, epoch, sample_idx, self.SAMPLE_SLOT)
+
+    def augmentation(self, epoch, sample_idx):
+        """
+        :return: RandomState for the random_state of the transforms, None for the global one
+        """
+        if self.seed is None:
+            return None
+        return data_transforms.sample_rng(self.seed, epoch, sample_idx, self.AUGMENTATION_SLOT)
+
+    def owns(self, batch_idx):
+        """
+        :param batch_idx: index of a batch among all batches yielded by the iterator
+        """
+        return batch_idx % self.n_workers == self.worker_id
+
+    def share(self, keys):
+        """
+        Keys of this worker, e.g. the patients of its PatientPool.
+        """
+        return list(keys)[self.worker_id::self.n_workers]
+
+
+def read_dsb_scan(patient_path, store=None):
+    """
+    Reads a DSB scan from the volume store when it holds the patient,
+    otherwise decodes the DICOM directory.
+    """
+    store = store or get_volume_store()
+    pid = utils_lung.extract_pid_dir(patient_path)
+    if store is not None and pid in store:
+        return store.read_scan(pid)
+    return utils_lung.read_dicom_scan(patient_path)
+
+
+def read_dsb_scan_roi(patient_path, patch_centers, transform_params, p_transform_augment=None, store=None):
+    """
+    Partial read of a DSB scan, limited to the boxes the patches around every one
+    of patch_centers can sample from. The volume spans the bounding box of the boxes,
+    the voxels outside the boxes are never sampled and are not read.
+    :return: volume of the roi, pixel spacing, patch centres shifted into the roi
+    """
+    def roi_fun(input_shape, pixel_spacing):
+        start, stop = data_transforms.patch_centers_bounding_box(patch_centers, input_shape, pixel_spacing,
+                                                                 transform_params, p_transform_augment)
+        boxes = data_transforms.patch_centers_boxes(patch_centers, input_shape, pixel_spacing,
+                                                    transform_params, p_transform_augment)
+        return start, stop, boxes
+
+    store = store or get_volume_store()
+    pid = utils_lung.extract_pid_dir(patient_path)
+    if store is not None and pid in store:
+        img, pixel_spacing, offset = store.read_scan_roi(pid, roi_fun)
+    else:
+        img, pixel_spacing, offset = utils_lung.load_dicom_volume_roi(patient_path, roi_fun)
+    return img, pixel_spacing, data_transforms.shift_patch_centers(patch_centers, offset)
+
+
 class LunaDataGenerator(object):
     def __init__(self, data_path, transform_params, data_prep_fun, rng,
                  random, infinite, patient_ids=None, **kwargs):
@@ -73,7 +342,7 @@ class LunaDataGenerator(object):
                 patient_path = self.patient_paths[idx]
                 pid = utils_lung.extract_pid_filename(patient_path)
 
-                img, origin, pixel_spacing = utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path)
                 x, y, annotations, tf_matrix = self.data_prep_fun(data=img,
                                                                   pixel_spacing=pixel_spacing,
                                                                   luna_annotations=
@@ -112,8 +381,7 @@ class LunaSimpleDataGenerator(object):
         for patient_path in self.patient_paths:
             pid = utils_lung.extract_pid_filename(patient_path)
 
-            img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+            img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
 
             x = np.float32(img)
 
@@ -151,7 +419,7 @@ class LunaScanPositiveLungMaskDataGenerator(LunaDataGenerator):
                 patient_path = self.patient_paths[idx]
                 pid = utils_lung.extract_pid_filename(patient_path)
 
-                img, origin, pixel_spacing = utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path)
                 x, y, lung_mask, annotations, tf_matrix = self.data_prep_fun(data=img,
                                                                              pixel_spacing=pixel_spacing,
                                                                              luna_annotations=
@@ -324,7 +592,10 @@ class LunaScanDataGenerator(object):
 
 class PatchPositiveLunaDataGenerator(object):
     def __init__(self, data_path, batch_size, transform_params, data_prep_fun, rng,
-                 full_batch, random, infinite, patient_ids=None, **kwargs):
+                 full_batch, random, infinite, patient_ids=None, seed=None, **kwargs):
+        """
+        :param seed: draw from counter-based SampleStreams, so batches do not depend on earlier batches
+        """
 
         self.id2annotations = utils_lung.read_luna_annotations(pathfinder.LUNA_LABELS_PATH)
 
@@ -347,15 +618,22 @@ class PatchPositiveLunaDataGenerator(object):
         self.transform_params = transform_params
         self.batch_size = batch_size
         self.full_batch = full_batch
+        self.streams = SampleStreams(seed, rng)
 
     def generate(self):
+        epoch, batch_idx = 0, 0
         while True:
             rand_idxs = np.arange(self.nsamples)#np.arange。返回一个范围，这个 范围大小等于self.nsample。
             if self.random:
-                self.rng.shuffle(rand_idxs) #将所有元素随机排序
+                self.streams.epoch(epoch).shuffle(rand_idxs) #将所有元素随机排序
             for pos in xrange(0, len(rand_idxs), self.batch_size):#生成的是一个生成器
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]#
                 nb = len(idxs_batch) 
+                yielded = nb == self.batch_size or not self.full_batch
+                if yielded:
+                    batch_idx += 1
+                    if not self.streams.owns(batch_idx - 1):
+                        continue
                 # allocate batches
                 x_batch = np.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')#设置零矩阵
                 y_batch = np.zeros((nb, 1) + self.transform_params['patch_size'], dtype='float32')
@@ -365,21 +643,21 @@ class PatchPositiveLunaDataGenerator(object):
                     patient_path = self.patient_paths[idx] #"LUNA_DATA_PATH": "/mnt/sda3/data/kaggle-lung/seg-lungs-LUNA16"，放置病人.mhd文件
                     id = utils_lung.extract_pid_filename(patient_path) #获取病人id
                     patients_ids.append(id) #将病人id加入病人id列表
-                    img, origin, pixel_spacing = utils_lung.read_mhd(patient_path)
+                    img, origin, pixel_spacing = read_luna_scan(patient_path)
 
                     patient_annotations = self.id2annotations[id]
-                    patch_center = patient_annotations[self.rng.randint(len(patient_annotations))]#randint()在区间内返回随机数
+                    sample_rng = self.streams.sample(epoch, pos + i)
+                    patch_center = patient_annotations[sample_rng.randint(len(patient_annotations))]#randint()在区间内返回随机数
                     x_batch[i, 0, :, :, :], y_batch[i, 0, :, :, :] = self.data_prep_fun(data=img,
                                                                                         patch_center=patch_center,
                                                                                         pixel_spacing=pixel_spacing,
                                                                                         luna_annotations=patient_annotations,
-                                                                                        luna_origin=origin)
-                if self.full_batch:
-                    if nb == self.batch_size:
-                        yield x_batch, y_batch, patients_ids
-                else:
+                                                                                        luna_origin=origin,
+                                                                                        random_state=self.streams.augmentation(epoch, pos + i))
+                if yielded:
                     yield x_batch, y_batch, patients_ids
 
+            epoch += 1
             if not self.infinite:
                 break
 
@@ -410,7 +688,7 @@ class ValidPatchPositiveLunaDataGenerator(object):
         for pid in self.id2positive_annotations.iterkeys():
             for patch_center in self.id2positive_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
-                img, origin, pixel_spacing = utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path)
 
                 patient_annotations = self.id2positive_annotations[pid]
                 x_batch, y_batch = self.data_prep_fun(data=img,
@@ -478,8 +756,7 @@ class CandidatesLunaDataGenerator(object):
                     id = utils_lung.extract_pid_filename(patient_path, self.file_extension)
                     patients_ids.append(id)
 
-                    img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                        if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                    img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                     if i < np.rint(self.batch_size * self.positive_proportion):
                         patient_annotations = self.id2positive_annotations[id]
                     else:
@@ -506,7 +783,16 @@ class CandidatesLunaDataGenerator(object):
 
 class CandidatesLunaDataGenerator(object):
     def __init__(self, data_path, batch_size, transform_params, patient_ids, data_prep_fun, rng,
-                 full_batch, random, infinite, positive_proportion, return_malignancy=False, **kwargs):
+                 full_batch, random, infinite, positive_proportion, return_malignancy=False,
+                 patient_pool_size=None, patches_per_patient=8, seed=None, **kwargs):
+        """
+        :param patient_pool_size: sample patches from a PatientPool of this many patients,
+                                  None draws a new patient for every patch
+        :param patches_per_patient: patches taken from a patient while it is in the pool
+        :param seed: draw from counter-based SampleStreams, so batches do not depend on earlier batches
+        """
+        if patient_pool_size and seed is not None:
+            raise ValueError('a patient pool depends on the earlier batches, it cannot be used with a seed')
 
         id2positive_annotations = utils_lung.read_luna_annotations(pathfinder.LUNA_LABELS_PATH)
         id2negative_annotations = utils_lung.read_luna_negative_candidates(pathfinder.LUNA_CANDIDATES_PATH)
@@ -540,34 +826,51 @@ class CandidatesLunaDataGenerator(object):
         self.transform_params = transform_params
         self.positive_proportion = positive_proportion
         self.return_malignancy = return_malignancy
+        self.patient_pool_size = patient_pool_size
+        self.patches_per_patient = patches_per_patient
+        self.streams = SampleStreams(seed, rng, seedable=not patient_pool_size)
 
     def generate(self):
+        pool = None
+        if self.patient_pool_size:
+            pool = PatientPool(self.streams.share(range(self.nsamples)),
+                               lambda idx: read_luna_scan(self.patient_paths[idx], self.file_extension),
+                               self.patient_pool_size, self.patches_per_patient, self.rng, self.random)
+        epoch, batch_idx = 0, 0
         while True:
             rand_idxs = np.arange(self.nsamples)
             if self.random:
-                self.rng.shuffle(rand_idxs)
+                self.streams.epoch(epoch).shuffle(rand_idxs)
             for pos in xrange(0, len(rand_idxs), self.batch_size):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
+                yielded = nb == self.batch_size or not self.full_batch
+                if yielded:
+                    batch_idx += 1
+                    if not self.streams.owns(batch_idx - 1):
+                        continue
                 # allocate batches
                 x_batch = np.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
                 y_batch = np.zeros((nb,), dtype='float32')
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
+                    scan = None
+                    if pool is not None:
+                        idx, scan = pool.draw()
                     patient_path = self.patient_paths[idx]
 
                     id = utils_lung.extract_pid_filename(patient_path, self.file_extension)
                     patients_ids.append(id)
 
-                    img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                        if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                    img, origin, pixel_spacing = scan or read_luna_scan(patient_path, self.file_extension)
                     if i < np.rint(self.batch_size * self.positive_proportion):
                         patient_annotations = self.id2positive_annotations[id]
                     else:
                         patient_annotations = self.id2negative_annotations[id]
 
-                    patch_center = patient_annotations[self.rng.randint(len(patient_annotations))]
+                    sample_rng = self.streams.sample(epoch, pos + i)
+                    patch_center = patient_annotations[sample_rng.randint(len(patient_annotations))]
 
                     if self.return_malignancy:
                         y_batch[i] = np.float32(diameter_to_prob(patch_center[-1]))
@@ -576,14 +879,13 @@ class CandidatesLunaDataGenerator(object):
                     x_batch[i, :, :, :] = self.data_prep_fun(data=img,
                                                                 patch_center=patch_center,
                                                                 pixel_spacing=pixel_spacing,
-                                                                luna_origin=origin)
+                                                                luna_origin=origin,
+                                                                random_state=self.streams.augmentation(epoch, pos + i))
 
-                if self.full_batch:
-                    if nb == self.batch_size:
-                        yield x_batch, y_batch, patients_ids
-                else:
+                if yielded:
                     yield x_batch, y_batch, patients_ids
 
+            epoch += 1
             if not self.infinite:
                 break
 
@@ -632,8 +934,7 @@ class CandidatesLunaValidDataGenerator(object):
             for patch_center in self.id2positive_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                 
                 if self.return_malignancy:
                     y_batch = np.array([diameter_to_prob(patch_center[-1])], dtype='float32')
@@ -650,8 +951,7 @@ class CandidatesLunaValidDataGenerator(object):
             for patch_center in self.id2negative_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                 y_batch = np.array([0.], dtype='float32')
                 x_batch = np.float32(self.data_prep_fun(data=img,
                                                         patch_center=patch_center,
@@ -681,14 +981,13 @@ class FixedCandidatesLunaDataGenerator(object):
         for pid in self.id2candidates_path.iterkeys():
             patient_path = self.id2patient_path[pid]
             print 'PATIENT', pid
-            candidates = utils.load_pkl(self.id2candidates_path[pid])
+            candidates = utils_lung.load_candidates(self.id2candidates_path[pid])
             if self.top_n is not None:
                 candidates = candidates[:self.top_n]
                 print candidates
             print 'n blobs', len(candidates)
 
-            img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+            img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
 
             for candidate in candidates:
                 y_batch = np.array(candidate, dtype='float32')
@@ -757,8 +1056,7 @@ class CandidatesLunaSizeDataGenerator(object):
                     id = utils_lung.extract_pid_filename(patient_path, self.file_extension)
                     patients_ids.append(id)
 
-                    img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                        if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                    img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                     if i < np.rint(self.batch_size * self.positive_proportion):
                         patient_annotations = self.id2positive_annotations[id]
                     else:
@@ -824,8 +1122,7 @@ class CandidatesLunaSizeValidDataGenerator(object):
             for patch_center in self.id2positive_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                 y_batch = np.array([[float(patch_center[-1])]], dtype='float32')
                 x_batch = np.float32(self.data_prep_fun(data=img,
                                                         patch_center=patch_center,
@@ -837,8 +1134,7 @@ class CandidatesLunaSizeValidDataGenerator(object):
             for patch_center in self.id2negative_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                 y_batch = np.array([[0.]], dtype='float32')
                 x_batch = np.float32(self.data_prep_fun(data=img,
                                                         patch_center=patch_center,
@@ -851,7 +1147,11 @@ class CandidatesLunaSizeValidDataGenerator(object):
 
 class CandidatesLunaSizeBinDataGenerator(object):
     def __init__(self, data_path, batch_size, transform_params, patient_ids, data_prep_fun, rng,
-                 full_batch, random, infinite, positive_proportion, bin_borders = [4,8,20,50], **kwargs):
+                 full_batch, random, infinite, positive_proportion, bin_borders = [4,8,20,50], seed=None,
+                 **kwargs):
+        """
+        :param seed: draw from counter-based SampleStreams, so batches do not depend on earlier batches
+        """
 
         id2positive_annotations = utils_lung.read_luna_annotations(pathfinder.LUNA_LABELS_PATH)
         id2negative_annotations = utils_lung.read_luna_negative_candidates(pathfinder.LUNA_CANDIDATES_PATH)
@@ -885,15 +1185,22 @@ class CandidatesLunaSizeBinDataGenerator(object):
         self.transform_params = transform_params
         self.positive_proportion = positive_proportion
         self.bin_borders = bin_borders
+        self.streams = SampleStreams(seed, rng)
 
     def generate(self):
+        epoch, batch_idx = 0, 0
         while True:
             rand_idxs = np.arange(self.nsamples)
             if self.random:
-                self.rng.shuffle(rand_idxs)
+                self.streams.epoch(epoch).shuffle(rand_idxs)
             for pos in xrange(0, len(rand_idxs), self.batch_size):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
                 nb = len(idxs_batch)
+                yielded = nb == self.batch_size or not self.full_batch
+                if yielded:
+                    batch_idx += 1
+                    if not self.streams.owns(batch_idx - 1):
+                        continue
                 # allocate batches
                 x_batch = np.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
                 y_batch = np.zeros((nb,), dtype='float32')
@@ -905,14 +1212,14 @@ class CandidatesLunaSizeBinDataGenerator(object):
                     id = utils_lung.extract_pid_filename(patient_path, self.file_extension)
                     patients_ids.append(id)
 
-                    img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                        if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                    img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                     if i < np.rint(self.batch_size * self.positive_proportion):
                         patient_annotations = self.id2positive_annotations[id]
                     else:
                         patient_annotations = self.id2negative_annotations[id]
 
-                    patch_center = patient_annotations[self.rng.randint(len(patient_annotations))]
+                    sample_rng = self.streams.sample(epoch, pos + i)
+                    patch_center = patient_annotations[sample_rng.randint(len(patient_annotations))]
 
                     diameter = patch_center[-1]
                     if diameter > 0.:
@@ -929,14 +1236,13 @@ class CandidatesLunaSizeBinDataGenerator(object):
                     x_batch[i, :, :, :] = self.data_prep_fun(data=img,
                                                                 patch_center=patch_center,
                                                                 pixel_spacing=pixel_spacing,
-                                                                luna_origin=origin)
+                                                                luna_origin=origin,
+                                                                random_state=self.streams.augmentation(epoch, pos + i))
 
-                if self.full_batch:
-                    if nb == self.batch_size:
-                        yield x_batch, y_batch, patients_ids
-                else:
+                if yielded:
                     yield x_batch, y_batch, patients_ids
 
+            epoch += 1
             if not self.infinite:
                 break
 
@@ -984,8 +1290,7 @@ class CandidatesLunaSizeBinValidDataGenerator(object):
             for patch_center in self.id2positive_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
 
                 diameter = patch_center[3]                        
                 ybin = 0
@@ -1005,8 +1310,7 @@ class CandidatesLunaSizeBinValidDataGenerator(object):
             for patch_center in self.id2negative_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                 y_batch = np.array([0.], dtype='float32')
                 x_batch = np.float32(self.data_prep_fun(data=img,
                                                         patch_center=patch_center,
@@ -1024,7 +1328,16 @@ class CandidatesLunaPropsDataGenerator(object):
                  order_objectives,
                  property_type,
                  property_bin_borders = None,
-                 return_enable_target_vector = False, **kwargs):
+                 return_enable_target_vector = False,
+                 patient_pool_size=None, patches_per_patient=8, seed=None, **kwargs):
+        """
+        :param patient_pool_size: sample patches from a PatientPool of this many positive
+                                  and this many negative patients, None draws a new patient for every patch
+        :param patches_per_patient: patches taken from a patient while it is in the pool
+        :param seed: draw from counter-based SampleStreams, so batches do not depend on earlier batches
+        """
+        if patient_pool_size and seed is not None:
+            raise ValueError('a patient pool depends on the earlier batches, it cannot be used with a seed')
 
         id2positive_annotations = utils_lung.read_luna_annotations(pathfinder.LUNA_LABELS_PATH)
         id2negative_annotations = utils_lung.read_luna_negative_candidates(pathfinder.LUNA_CANDIDATES_PATH)
@@ -1074,12 +1387,13 @@ class CandidatesLunaPropsDataGenerator(object):
         self.order_objectives = order_objectives
         self.property_bin_borders = property_bin_borders
 	self.property_type = property_type
+        self.patient_pool_size = patient_pool_size
+        self.patches_per_patient = patches_per_patient
+        self.streams = SampleStreams(seed, rng, seedable=not patient_pool_size)
         #self.return_enable_target_vector = return_enable_target_vector
 
-    def L2(self, a,b):
-        return ((a[0]-b[0])**2 + (a[1]-b[1])**2 + (a[2]-b[2])**2)**(0.5)
-
-    def build_ground_truth_vector(self, pid, patch_center):
+    def build_ground_truth_vector(self, pid, patch_center, random_state=None):
+        random_state = random_state or self.rng
         properties={}
         feature_vector = np.zeros((len(self.order_objectives)), dtype='float32')
         enable_target_vector = np.zeros((len(self.order_objectives)), dtype='float32')
@@ -1092,28 +1406,17 @@ class CandidatesLunaPropsDataGenerator(object):
             else:
                 properties['size'] = diameter
             
-            patient = utils_lung.read_patient_annotations_luna(pid, pathfinder.LUNA_NODULE_ANNOTATIONS_PATH)
-
             #find the nodules in the doctor's annotations
-            nodule_characteristics = []
-            for doctor in patient:
-                for nodule in doctor:
-                    if "centroid_xyz" in nodule:
-                        dist = self.L2(patch_center[:3],nodule["centroid_xyz"][::-1])
-                        if  dist < 5:
-                            #print 'found a very close nodule at', dist, ': ', patch_center[:3]
-                            nodule_characteristics.append(nodule['characteristics'])
+            prop_names, nodule_characteristics = get_nodule_index().close_nodules(pid, patch_center[:3])
 
             if len(nodule_characteristics)==0:
                 print 'WARNING: no nodule found in doctor annotations for ', patch_center
             else:
                 #calculate the median property values
-                for prop in nodule_characteristics[0]:
+                for prop, prop_values in zip(prop_names, nodule_characteristics.T):
                     if prop in self.order_objectives:
-                        prop_values = []
-                        for nchar in nodule_characteristics:
-                            prop_values.append(float(nchar[prop]))
-                            random_value = self.rng.choice(np.array(prop_values))
+                        for n in xrange(1, len(prop_values) + 1):
+                            random_value = random_state.choice(prop_values[:n])
                             if prop in self.property_bin_borders:
                                 properties[prop] = np.digitize(random_value, self.property_bin_borders[prop])
                             else:      
@@ -1133,6 +1436,15 @@ class CandidatesLunaPropsDataGenerator(object):
         return feature_vector, enable_target_vector
 
     def generate(self):
+        pos_pool, neg_pool = None, None
+        if self.patient_pool_size:
+            load_fun = lambda pid: read_luna_scan(self.data_path + '/' + pid + self.file_extension,
+                                                  self.file_extension)
+            pos_pool = PatientPool(self.streams.share(self.pos_pids), load_fun, self.patient_pool_size,
+                                   self.patches_per_patient, self.rng, self.random)
+            neg_pool = PatientPool(self.streams.share(self.neg_pids), load_fun, self.patient_pool_size,
+                                   self.patches_per_patient, self.rng, self.random)
+        epoch, batch_idx = 0, 0
         while True:
             # Construct pid set with
             rand_pos_idxs = np.arange(self.n_pos_pids)
@@ -1141,8 +1453,9 @@ class CandidatesLunaPropsDataGenerator(object):
             ptr_neg_idcs = 0
 
             if self.random:
-                self.rng.shuffle(rand_pos_idxs)
-                self.rng.shuffle(rand_neg_idxs)
+                epoch_rng = self.streams.epoch(epoch)
+                epoch_rng.shuffle(rand_pos_idxs)
+                epoch_rng.shuffle(rand_neg_idxs)
 
             n_pos_batch = int(np.rint(self.batch_size * self.positive_proportion))
             n_neg_batch = self.batch_size - n_pos_batch
@@ -1151,6 +1464,11 @@ class CandidatesLunaPropsDataGenerator(object):
                 neg_idxs_batch = rand_neg_idxs[_idx * n_neg_batch:(_idx+1) * n_neg_batch]
 
                 nb = len(pos_idxs_batch) + len(neg_idxs_batch)
+                yielded = nb == self.batch_size or not self.full_batch
+                if yielded:
+                    batch_idx += 1
+                    if not self.streams.owns(batch_idx - 1):
+                        continue
                 # allocate batches
                 x_batch = np.zeros((nb,) + self.transform_params['patch_size'], dtype='float32')
                 y_batch = np.zeros((nb, len(self.order_objectives)), dtype='float32')
@@ -1159,48 +1477,60 @@ class CandidatesLunaPropsDataGenerator(object):
 
                 batch_ptr = 0
                 for idx in pos_idxs_batch:
-                    pid  = self.pos_pids[idx]
+                    scan = None
+                    if pos_pool is not None:
+                        pid, scan = pos_pool.draw()
+                    else:
+                        pid = self.pos_pids[idx]
                     patient_path = self.data_path + '/' + pid + self.file_extension
                     patients_ids.append(pid)
 
-                    img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                        if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                    img, origin, pixel_spacing = scan or read_luna_scan(patient_path, self.file_extension)
 
                     patient_annotations = self.id2positive_annotations[pid]
-                    patch_center = patient_annotations[self.rng.randint(len(patient_annotations))]
+                    sample_idx = _idx * self.batch_size + batch_ptr
+                    sample_rng = self.streams.sample(epoch, sample_idx)
+                    patch_center = patient_annotations[sample_rng.randint(len(patient_annotations))]
 
-                    y_batch[batch_ptr], z_batch[batch_ptr] = self.build_ground_truth_vector(pid, patch_center)
+                    y_batch[batch_ptr], z_batch[batch_ptr] = self.build_ground_truth_vector(pid, patch_center,
+                                                                                            sample_rng)
                     x_batch[batch_ptr, :, :, :] = self.data_prep_fun(data=img,
                                                                 patch_center=patch_center,
                                                                 pixel_spacing=pixel_spacing,
-                                                                luna_origin=origin)
+                                                                luna_origin=origin,
+                                                                random_state=self.streams.augmentation(epoch, sample_idx))
                     batch_ptr += 1
 
                 for idx in neg_idxs_batch:
-                    pid  = self.neg_pids[idx]
+                    scan = None
+                    if neg_pool is not None:
+                        pid, scan = neg_pool.draw()
+                    else:
+                        pid = self.neg_pids[idx]
                     patient_path = self.data_path + '/' + pid + self.file_extension
                     patients_ids.append(pid)
 
-                    img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                        if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                    img, origin, pixel_spacing = scan or read_luna_scan(patient_path, self.file_extension)
 
                     patient_annotations = self.id2negative_annotations[pid]
-                    patch_center = patient_annotations[self.rng.randint(len(patient_annotations))]
+                    sample_idx = _idx * self.batch_size + batch_ptr
+                    sample_rng = self.streams.sample(epoch, sample_idx)
+                    patch_center = patient_annotations[sample_rng.randint(len(patient_annotations))]
 
-                    y_batch[batch_ptr], z_batch[batch_ptr] = self.build_ground_truth_vector(pid, patch_center)
+                    y_batch[batch_ptr], z_batch[batch_ptr] = self.build_ground_truth_vector(pid, patch_center,
+                                                                                            sample_rng)
                     x_batch[batch_ptr, :, :, :] = self.data_prep_fun(data=img,
                                                                 patch_center=patch_center,
                                                                 pixel_spacing=pixel_spacing,
-                                                                luna_origin=origin)
+                                                                luna_origin=origin,
+                                                                random_state=self.streams.augmentation(epoch, sample_idx))
                     batch_ptr += 1
 
 
-                if self.full_batch:
-                    if nb == self.batch_size:
-                        yield x_batch, y_batch, z_batch, patients_ids
-                else:
+                if yielded:
                     yield x_batch, y_batch, z_batch, patients_ids
 
+            epoch += 1
             if not self.infinite:
                 break
 
@@ -1248,10 +1578,6 @@ class CandidatesLunaPropsValidDataGenerator(object):
         self.property_type = property_type
     
 
-    def L2(self, a,b):
-        return ((a[0]-b[0])**2 + (a[1]-b[1])**2 + (a[2]-b[2])**2)**(0.5)
-
-
     def build_ground_truth_vector(self, pid, patch_center):
         properties={}
         feature_vector = np.zeros((len(self.order_objectives)), dtype='float32')
@@ -1265,32 +1591,20 @@ class CandidatesLunaPropsValidDataGenerator(object):
             else:
                 properties['size'] = diameter
             
-            patient = utils_lung.read_patient_annotations_luna(pid, pathfinder.LUNA_NODULE_ANNOTATIONS_PATH)
-
             #find the nodules in the doctor's annotations
-            nodule_characteristics = []
-            for doctor in patient:
-                for nodule in doctor:
-                    if "centroid_xyz" in nodule:
-                        dist = self.L2(patch_center[:3],nodule["centroid_xyz"][::-1])
-                        if  dist < 5:
-                            #print 'found a very close nodule at', dist, ': ', patch_center[:3]
-                            nodule_characteristics.append(nodule['characteristics'])
+            prop_names, nodule_characteristics = get_nodule_index().close_nodules(pid, patch_center[:3])
 
             if len(nodule_characteristics)==0:
                 print 'WARNING: no nodule found in doctor annotations for ', patch_center
             else:
                 #calculate the median property values
-                for prop in nodule_characteristics[0]:
+                for prop, prop_values in zip(prop_names, nodule_characteristics.T):
                     if prop in self.order_objectives:
-                        prop_values = []
-                        for nchar in nodule_characteristics:
-                            prop_values.append(float(nchar[prop]))
                         if prop in self.property_bin_borders:
-                            median_value = np.median(np.array(prop_values))
+                            median_value = np.median(prop_values)
                             properties[prop] = np.digitize(median_value, self.property_bin_borders[prop])
                         else:
-                            mean_value = np.mean(np.array(prop_values))
+                            mean_value = np.mean(prop_values)
                             if self.property_type:
                                 if self.property_type[prop] == 'bounded_continuous':
                                     properties[prop] = (mean_value-1) / 4.
@@ -1313,8 +1627,7 @@ class CandidatesLunaPropsValidDataGenerator(object):
             for patch_center in self.id2positive_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
 
                 x_batch = np.float32(self.data_prep_fun(data=img,
                                                         patch_center=patch_center,
@@ -1330,8 +1643,7 @@ class CandidatesLunaPropsValidDataGenerator(object):
             for patch_center in self.id2negative_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
 
                 x_batch = np.float32(self.data_prep_fun(data=img,
                                                         patch_center=patch_center,
@@ -1346,20 +1658,27 @@ class CandidatesLunaPropsValidDataGenerator(object):
 
 
 class DSBScanDataGenerator(object):
-    def __init__(self, data_path, transform_params, data_prep_fun, **kwargs):
+    def __init__(self, data_path, transform_params, data_prep_fun, isotropic=False, **kwargs):
         self.patient_paths = utils_lung.get_patient_data_paths(data_path)
         self.nsamples = len(self.patient_paths)
         self.data_path = data_path
         self.data_prep_fun = data_prep_fun
         self.transform_params = transform_params
+        # read scans from the isotropic store, tf_matrix still maps to the original voxels
+        self.isotropic = isotropic
 
     def generate(self):
         for p in self.patient_paths:
             pid = utils_lung.extract_pid_dir(p)
 
-            img, pixel_spacing = utils_lung.read_dicom_scan(p)
+            if self.isotropic:
+                img, pixel_spacing, voxel_tf = read_dsb_scan_isotropic(p)
+            else:
+                img, pixel_spacing = read_dsb_scan(p)
 
             x, tf_matrix = self.data_prep_fun(data=img, pixel_spacing=pixel_spacing)
+            if self.isotropic:
+                tf_matrix = voxel_tf.dot(tf_matrix)
 
             x = np.float32(x)[None, None, :, :, :]
             yield x, None, tf_matrix, pid
@@ -1399,7 +1718,7 @@ class DSBScanLungMaskDataGenerator(object):
         for p in self.patient_paths:
             pid = utils_lung.extract_pid_dir(p) #返回数据文件文件名称
 
-            img, pixel_spacing = utils_lung.read_dicom_scan(p) #读取数据文件信息
+            img, pixel_spacing = read_dsb_scan(p) #读取数据文件信息
 
             x, lung_mask, tf_matrix = self.data_prep_fun(data=img, pixel_spacing=pixel_spacing) #这里调用数据处理函数，产生mask
 
@@ -1409,7 +1728,8 @@ class DSBScanLungMaskDataGenerator(object):
 
 
 class CandidatesDSBDataGenerator(object):
-    def __init__(self, data_path, transform_params, id2candidates_path, data_prep_fun, exclude_pids=None):
+    def __init__(self, data_path, transform_params, id2candidates_path, data_prep_fun, exclude_pids=None,
+                 partial_read=False, p_transform_augment=None, isotropic=False):
         if exclude_pids is not None:
             for p in exclude_pids:
                 id2candidates_path.pop(p, None)
@@ -1423,20 +1743,37 @@ class CandidatesDSBDataGenerator(object):
         self.data_path = data_path
         self.data_prep_fun = data_prep_fun
         self.transform_params = transform_params
+        # only read the part of the scan the candidate patches need
+        self.partial_read = partial_read
+        self.p_transform_augment = p_transform_augment
+        # read scans from the isotropic store, candidates are mapped onto its voxels
+        if isotropic and partial_read:
+            raise ValueError('isotropic and partial_read cannot be combined')
+        self.isotropic = isotropic
 
     def generate(self):
 
         for pid in self.id2candidates_path.iterkeys():
             patient_path = self.id2patient_path[pid]
             print pid, patient_path
-            img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
-
             print self.id2candidates_path[pid]
-            candidates = utils.load_pkl(self.id2candidates_path[pid])
+            candidates = utils_lung.load_candidates(self.id2candidates_path[pid])
             print candidates.shape
-            for candidate in candidates:
+
+            if self.isotropic:
+                img, pixel_spacing, voxel_tf = read_dsb_scan_isotropic(patient_path)
+                patch_centers = data_transforms.transform_patch_centers(candidates, np.linalg.inv(voxel_tf))
+            elif self.partial_read:
+                img, pixel_spacing, patch_centers = read_dsb_scan_roi(patient_path, candidates,
+                                                                      self.transform_params,
+                                                                      self.p_transform_augment)
+            else:
+                img, pixel_spacing = read_dsb_scan(patient_path)
+                patch_centers = candidates
+
+            for candidate, patch_center in zip(candidates, patch_centers):
                 y_batch = np.array(candidate, dtype='float32')
-                patch_center = candidate[:3]
+                patch_center = patch_center[:3]
                 x_batch = np.float32(self.data_prep_fun(data=img,
                                                         patch_center=patch_center,
                                                         pixel_spacing=pixel_spacing))[None, :, :, :]
@@ -1447,7 +1784,8 @@ class CandidatesDSBDataGenerator(object):
 
 
 class CandidatesDSBDataGeneratorTTA(object):
-    def __init__(self, data_path, transform_params, id2candidates_path, data_prep_fun, exclude_pids=None, tta=64):
+    def __init__(self, data_path, transform_params, id2candidates_path, data_prep_fun, exclude_pids=None, tta=64,
+                 partial_read=False, p_transform_augment=None):
         if exclude_pids is not None:
             for p in exclude_pids:
                 id2candidates_path.pop(p, None)
@@ -1462,20 +1800,30 @@ class CandidatesDSBDataGeneratorTTA(object):
         self.data_prep_fun = data_prep_fun
         self.transform_params = transform_params
         self.tta = tta
+        # only read the part of the scan the candidate patches need
+        self.partial_read = partial_read
+        self.p_transform_augment = p_transform_augment
 
     def generate(self):
 
         for pid in self.id2candidates_path.iterkeys():
             patient_path = self.id2patient_path[pid]
             print pid, patient_path
-            img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
-
             print self.id2candidates_path[pid]
-            candidates = utils.load_pkl(self.id2candidates_path[pid])
+            candidates = utils_lung.load_candidates(self.id2candidates_path[pid])
             print candidates.shape
-            for candidate in candidates:
+
+            if self.partial_read:
+                img, pixel_spacing, patch_centers = read_dsb_scan_roi(patient_path, candidates,
+                                                                      self.transform_params,
+                                                                      self.p_transform_augment)
+            else:
+                img, pixel_spacing = read_dsb_scan(patient_path)
+                patch_centers = candidates
+
+            for candidate, patch_center in zip(candidates, patch_centers):
                 y_batch = np.array(candidate, dtype='float32')
-                patch_center = candidate[:3]
+                patch_center = patch_center[:3]
                 batch = []
                 for i in range(self.tta):
                     batch.append(np.float32(self.data_prep_fun(data=img,
@@ -1551,7 +1899,11 @@ class DSBFeatureDataGenerator(object):
 
 class DSBPatientsDataGenerator(object):
     def __init__(self, data_path, batch_size, transform_params, id2candidates_path, id2label, data_prep_fun,
-                 n_candidates_per_patient, rng, random, infinite, candidates_prep_fun, return_patch_locs=False, shuffle_top_n=False, patient_ids=None):
+                 n_candidates_per_patient, rng, random, infinite, candidates_prep_fun, return_patch_locs=False, shuffle_top_n=False, patient_ids=None,
+                 partial_read=False, p_transform_augment=None, isotropic=False, seed=None):
+        """
+        :param seed: draw from counter-based SampleStreams, so batches do not depend on earlier batches
+        """
 
         self.id2label = id2label #utils_lung.read_labels(pathfinder.LABELS_PATH)
         self.id2candidates_path = id2candidates_path
@@ -1575,15 +1927,30 @@ class DSBPatientsDataGenerator(object):
         self.shuffle_top_n = shuffle_top_n
         self.return_patch_locs = return_patch_locs
         self.candidates_prep_fun = candidates_prep_fun
+        # only read the part of the scan the candidate patches need
+        self.partial_read = partial_read
+        self.p_transform_augment = p_transform_augment
+        # read scans from the isotropic store, candidates are mapped onto its voxels
+        if isotropic and partial_read:
+            raise ValueError('isotropic and partial_read cannot be combined')
+        self.isotropic = isotropic
+        self.streams = SampleStreams(seed, rng)
 
     def generate(self):
+        epoch, batch_idx = 0, 0
         while True:
             rand_idxs = np.arange(self.nsamples)
             if self.random:
-                self.rng.shuffle(rand_idxs)
+                self.streams.epoch(epoch).shuffle(rand_idxs)
 
             for pos in xrange(0, len(rand_idxs), self.batch_size):
                 idxs_batch = rand_idxs[pos:pos + self.batch_size]
+                # only full batches are yielded and counted
+                yielded = len(idxs_batch) == self.batch_size
+                if yielded:
+                    batch_idx += 1
+                    if not self.streams.owns(batch_idx - 1):
+                        continue
 
                 x_batch = np.zeros((self.batch_size, self.n_candidates_per_patient,)
                                    + self.transform_params['patch_size'], dtype='float32')
@@ -1597,33 +1964,50 @@ class DSBPatientsDataGenerator(object):
                 for i, idx in enumerate(idxs_batch):
                     patient_path = self.patient_paths[idx]
                     pid = utils_lung.extract_pid_dir(patient_path)
+                    sample_rng = self.streams.sample(epoch, pos + i)
 
-                    img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
-
-                    all_candidates = utils.load_pkl(self.id2candidates_path[pid])
+                    all_candidates = utils_lung.load_candidates(self.id2candidates_path[pid])
                     if self.candidates_prep_fun:
                         top_candidates = self.candidates_prep_fun(all_candidates, self.n_candidates_per_patient)
                     else:
                         top_candidates = all_candidates[:self.n_candidates_per_patient]
                         if self.shuffle_top_n:
-                            self.rng.shuffle(top_candidates)
+                            sample_rng.shuffle(top_candidates)
 
                     if self.return_patch_locs:
                         #TODO move the normalization to the config file
                         x_loc_batch[i] = np.float32(top_candidates[:,:3])/512. 
 
-                    x_batch[i] = np.float32(self.data_prep_fun(data=img, pid=pid,
-                                                               patch_centers=top_candidates,
-                                                               pixel_spacing=pixel_spacing))[:, :, :, :]
+                    if self.isotropic:
+                        img, pixel_spacing, voxel_tf = read_dsb_scan_isotropic(patient_path)
+                        patch_centers = data_transforms.transform_patch_centers(top_candidates,
+                                                                                np.linalg.inv(voxel_tf))
+                    elif self.partial_read:
+                        img, pixel_spacing, patch_centers = read_dsb_scan_roi(patient_path, top_candidates,
+                                                                              self.transform_params,
+                                                                              self.p_transform_augment)
+                    else:
+                        img, pixel_spacing = read_dsb_scan(patient_path)
+                        patch_centers = top_candidates
+
+                    # patches are sampled straight into the batch slab, configs forward snap_to_grid
+                    # to transform_dsb_candidates to crop the candidates of isotropic scans
+                    x_batch[i] = self.data_prep_fun(data=img, pid=pid,
+                                                    patch_centers=patch_centers,
+                                                    pixel_spacing=pixel_spacing,
+                                                    out=x_batch[i],
+                                                    random_state=self.streams.augmentation(epoch, pos + i),
+                                                    snap_to_grid=self.isotropic)
                     y_batch[i] = self.id2label.get(pid)
                     pids_batch.append(pid)
 
-                if len(idxs_batch) == self.batch_size:
+                if yielded:
                     if self.return_patch_locs:
                         yield x_batch, x_loc_batch, y_batch, pids_batch
                     else:
                         yield x_batch, y_batch, pids_batch
 
+            epoch += 1
             if not self.infinite:
                 break
 
@@ -1662,18 +2046,19 @@ class DSBPatientsDataGeneratorTTA(object):
             patient_path = self.patient_paths[idx]
             pid = utils_lung.extract_pid_dir(patient_path)
 
-            img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
+            img, pixel_spacing = read_dsb_scan(patient_path)
 
-            all_candidates = utils.load_pkl(self.id2candidates_path[pid])
+            all_candidates = utils_lung.load_candidates(self.id2candidates_path[pid])
             if self.candidates_prep_fun:
                 top_candidates = self.candidates_prep_fun(all_candidates, self.n_candidates_per_patient)
             else:
                 top_candidates = all_candidates[:self.n_candidates_per_patient]
 
             for i in range(self.tta):
-                x_batch[i] = np.float32(self.data_prep_fun(data=img,
-                                                           patch_centers=top_candidates,
-                                                           pixel_spacing=pixel_spacing))[:, :, :, :]
+                x_batch[i] = self.data_prep_fun(data=img,
+                                                patch_centers=top_candidates,
+                                                pixel_spacing=pixel_spacing,
+                                                out=x_batch[i])
 
                 y_batch[i] = self.id2label.get(pid)
 
@@ -1704,7 +2089,7 @@ class DSBPixelSpacingsGenerator(object):
             patient_path = self.patient_paths[idx]
             pid = utils_lung.extract_pid_dir(patient_path)
 
-            img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
+            img, pixel_spacing = read_dsb_scan(patient_path)
 
             yield  pid, pixel_spacing
 
@@ -1754,9 +2139,9 @@ class DSBPatientsDataGenerator_only_heatmap(object):
                     patient_path = self.patient_paths[idx]
                     pid = utils_lung.extract_pid_dir(patient_path)
 
-                    img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
+                    img, pixel_spacing = read_dsb_scan(patient_path)
 
-                    all_candidates = utils.load_pkl(self.id2candidates_path[pid])
+                    all_candidates = utils_lung.load_candidates(self.id2candidates_path[pid])
                     candidates_w_value = self.candidates_prep_fun(all_candidates)
 
                     x_batch[i] = np.float32(self.data_prep_fun(data=img,
@@ -1817,8 +2202,8 @@ class DSBPatientsDataGeneratorRandomSelectionNonCancerous(object):
                     patient_path = self.patient_paths[idx]
                     pid = utils_lung.extract_pid_dir(patient_path)
 
-                    img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
-                    all_candidates = utils.load_pkl(self.id2candidates_path[pid])
+                    img, pixel_spacing = read_dsb_scan(patient_path)
+                    all_candidates = utils_lung.load_candidates(self.id2candidates_path[pid])
 
                     label = self.id2label.get(pid)
                     if label:
@@ -1915,8 +2300,8 @@ class BalancedDSBPatientsDataGenerator(object):
         y_batch = np.zeros((len(batch_pids),), dtype='float32')
         for i, pid in enumerate(batch_pids):
             patient_path = self.data_path + '/' + str(pid)
-            img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)  
-            all_candidates = utils.load_pkl(self.id2candidates_path[pid])
+            img, pixel_spacing = read_dsb_scan(patient_path)  
+            all_candidates = utils_lung.load_candidates(self.id2candidates_path[pid])
             top_candidates = all_candidates[:self.n_candidates_per_patient]                       
             if self.shuffle_top_n:
                 self.rng.shuffle(top_candidates)
@@ -1942,7 +2327,7 @@ class DSBDataGenerator(object):
         for p in self.patient_paths:
             pid = utils_lung.extract_pid_dir(p)
 
-            img, pixel_spacing = utils_lung.read_dicom_scan(p)
+            img, pixel_spacing = read_dsb_scan(p)
 
             if self.data_prep_fun:
                 x, tf_matrix = self.data_prep_fun(data=img, pixel_spacing=pixel_spacing)
@@ -1959,7 +2344,12 @@ class CandidatesPropertiesLunaDataGenerator(object):
     def __init__(self, data_path, batch_size, transform_params, label_prep_fun,
                  nproperties,  patient_ids, data_prep_fun, rng,
                  full_batch, random, infinite, positive_proportion, properties_included=[],
-                 random_negative_samples=False, **kwargs):
+                 random_negative_samples=False, patient_pool_size=None, patches_per_patient=8, **kwargs):
+        """
+        :param patient_pool_size: sample patches from a PatientPool of this many positive
+                                  and this many negative patients, None iterates over the annotations
+        :param patches_per_patient: patches taken from a patient while it is in the pool
+        """
 
         id2positive_annotations = utils_lung.read_luna_properties(pathfinder.LUNA_PROPERTIES_PATH)
         id2negative_annotations = utils_lung.read_luna_negative_candidates(pathfinder.LUNA_CANDIDATES_PATH)
@@ -2015,10 +2405,21 @@ class CandidatesPropertiesLunaDataGenerator(object):
         if len(properties_included)>0:
             self.nlabels=len(properties_included)
         self.properties_included = properties_included
+        self.patient_pool_size = patient_pool_size
+        self.patches_per_patient = patches_per_patient
 
         assert self.transform_params['pixel_spacing'] == (1., 1., 1.)
 
     def generate(self):
+        pos_pool, neg_pool = None, None
+        if self.patient_pool_size:
+            # positive slots come first, as in the other candidate generators
+            load_fun = lambda pid: read_luna_scan(self.pid2patient_path[pid], self.file_extension)
+            pos_pool = PatientPool(sorted(self.id2positive_annotations.keys()), load_fun,
+                                   self.patient_pool_size, self.patches_per_patient, self.rng, self.random)
+            neg_pool = PatientPool(sorted(self.id2negative_annotations.keys()), load_fun,
+                                   self.patient_pool_size, self.patches_per_patient, self.rng, self.random)
+            n_pos_batch = np.rint(self.batch_size * self.positive_proportion)
         while True:
             rand_idxs = np.arange(self.nsamples)
             if self.random:
@@ -2032,7 +2433,17 @@ class CandidatesPropertiesLunaDataGenerator(object):
                 patients_ids = []
 
                 for i, idx in enumerate(idxs_batch):
-                    pid, patch_annotation = self.idx2pid_annotation[idx]
+                    scan = None
+                    if pos_pool is not None:
+                        if i < n_pos_batch:
+                            pid, scan = pos_pool.draw()
+                            patient_annotations = self.id2positive_annotations[pid]
+                        else:
+                            pid, scan = neg_pool.draw()
+                            patient_annotations = self.id2negative_annotations[pid]
+                        patch_annotation = patient_annotations[self.rng.randint(len(patient_annotations))]
+                    else:
+                        pid, patch_annotation = self.idx2pid_annotation[idx]
 
                     if pid is None:
                         pid = self.rng.choice(self.id2negative_annotations.keys())
@@ -2045,8 +2456,7 @@ class CandidatesPropertiesLunaDataGenerator(object):
                     y_batch[i] = self.label_prep_fun(patch_annotation,self.properties_included)
                     # print pid, y_batch[i]
 
-                    img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                        if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                    img, origin, pixel_spacing = scan or read_luna_scan(patient_path, self.file_extension)
 
                     patch_zyxd = patch_annotation[:4]
                     x_batch[i, :, :, :] = self.data_prep_fun(data=img, pid = pid,
@@ -2157,8 +2567,7 @@ class CandidatesPropertiesLunaDataGenerator2(object):
                     y_batch[i] = self.label_prep_fun(patch_annotation,self.properties_included)
                     # print pid, y_batch[i]
 
-                    img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                        if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                    img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
 
                     patch_zyxd = patch_annotation[:4]
                     x_batch[i, :, :, :] = self.data_prep_fun(data=img, pid = pid,
@@ -2225,8 +2634,7 @@ class CandidatesLunaValidDataGenerator2(object):
             for patch_center in self.id2positive_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                 if self.label_prep_fun is None:
                     y_batch = np.array([1.], dtype='float32')
                 else:
@@ -2241,8 +2649,7 @@ class CandidatesLunaValidDataGenerator2(object):
             for patch_center in self.id2negative_annotations[pid]:
                 patient_path = self.id2patient_path[pid]
 
-                img, origin, pixel_spacing = utils_lung.read_pkl(patient_path) \
-                    if self.file_extension == '.pkl' else utils_lung.read_mhd(patient_path)
+                img, origin, pixel_spacing = read_luna_scan(patient_path, self.file_extension)
                 y_batch = np.array([0.], dtype='float32')
                 x_batch = np.float32(self.data_prep_fun(data=img, pid=pid,
                                                         patch_center=patch_center,
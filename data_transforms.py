@@ -1,4 +1,5 @@
 from collections import namedtuple
+import itertools
 import numpy as np
 import scipy.ndimage
 import math
@@ -156,15 +157,28 @@ def apply_hist_eq_patch(x, bins, original_borders):
     return z
 
 
-def sample_augmentation_parameters(transformation):
-    shift_z = rng.uniform(*transformation.get('translation_range_z', [0., 0.]))
-    shift_y = rng.uniform(*transformation.get('translation_range_y', [0., 0.]))
-    shift_x = rng.uniform(*transformation.get('translation_range_x', [0., 0.]))
+def sample_rng(seed, *counters):
+    """
+    Counter-based random stream: the RandomState of e.g. (seed, epoch, sample index, slot)
+    only depends on these numbers and not on the draws made before it, so samples can be
+    augmented in any order and in any process with the same result.
+    """
+    return np.random.RandomState([seed] + [int(c) for c in counters])
+
+
+def sample_augmentation_parameters(transformation, random_state=None):
+    """
+    :param random_state: RandomState to draw from, the global augmentation rng if None
+    """
+    random_state = random_state or rng
+    shift_z = random_state.uniform(*transformation.get('translation_range_z', [0., 0.]))
+    shift_y = random_state.uniform(*transformation.get('translation_range_y', [0., 0.]))
+    shift_x = random_state.uniform(*transformation.get('translation_range_x', [0., 0.]))
     translation = (shift_z, shift_y, shift_x)
 
-    rotation_z = rng.uniform(*transformation.get('rotation_range_z', [0., 0.]))
-    rotation_y = rng.uniform(*transformation.get('rotation_range_y', [0., 0.]))
-    rotation_x = rng.uniform(*transformation.get('rotation_range_x', [0., 0.]))
+    rotation_z = random_state.uniform(*transformation.get('rotation_range_z', [0., 0.]))
+    rotation_y = random_state.uniform(*transformation.get('rotation_range_y', [0., 0.]))
+    rotation_x = random_state.uniform(*transformation.get('rotation_range_x', [0., 0.]))
     rotation = (rotation_z, rotation_y, rotation_x)
 
     return namedtuple('Params', ['translation', 'rotation'])(translation, rotation)
@@ -175,7 +189,12 @@ def transform_scan3d(data, pixel_spacing, p_transform,
                      luna_origin=None,
                      p_transform_augment=None,
                      world_coord_system=True,
-                     lung_mask=None):
+                     lung_mask=None,
+                     random_state=None,
+                     canvas_center=None):
+    """
+    :param canvas_center: voxel of the scan at the center of the output, the center of the scan if None
+    """
     mm_patch_size = np.asarray(p_transform['mm_patch_size'], dtype='float32')
     out_pixel_spacing = np.asarray(p_transform['pixel_spacing'])
 
@@ -188,13 +207,16 @@ def transform_scan3d(data, pixel_spacing, p_transform,
     # https://www.cs.mtu.edu/~shene/COURSES/cs3621/NOTES/geometry/geo-tran.html
     # but the affine_transform() makes it reversed for scipy
     tf_mm_scale = affine_transform(scale=mm_shape / input_shape)
-    tf_shift_center = affine_transform(translation=-mm_shape / 2.)
+    if canvas_center is None:
+        tf_shift_center = affine_transform(translation=-mm_shape / 2.)
+    else:
+        tf_shift_center = affine_transform(translation=-np.asarray(canvas_center) * mm_shape / input_shape)
 
     tf_shift_uncenter = affine_transform(translation=mm_patch_size / 2.)
     tf_output_scale = affine_transform(scale=output_shape / mm_patch_size)
 
     if p_transform_augment:
-        augment_params_sample = sample_augmentation_parameters(p_transform_augment)
+        augment_params_sample = sample_augmentation_parameters(p_transform_augment, random_state)
         tf_augment = affine_transform(translation=augment_params_sample.translation,
                                       rotation=augment_params_sample.rotation)
         tf_total = tf_mm_scale.dot(tf_shift_center).dot(tf_augment).dot(tf_shift_uncenter).dot(tf_output_scale)
@@ -229,12 +251,42 @@ def transform_scan3d(data, pixel_spacing, p_transform,
         return data_out, tf_total, lung_mask_out
 
 
+def lung_canvas(lung_mask, pixel_spacing, p_transform, window_size, stride, margin=16.):
+    """
+    Adaptive output canvas of transform_scan3d for the sliding window prediction: the bounding
+    box of the lung mask plus a margin, rounded up to the window grid. The windows predict the
+    central cube of the canvas, so (window_size - stride) / 2 voxels are added on every side.
+    :param margin: margin around the lungs in output voxels
+    :return: p_transform with the patch_size and mm_patch_size of the canvas, canvas_center
+             for transform_scan3d, or the unchanged p_transform and None for an empty mask
+    """
+    start, stop = [], []
+    for axis in xrange(3):
+        idxs = np.flatnonzero(np.any(lung_mask, axis=tuple(a for a in xrange(3) if a != axis)))
+        if len(idxs) == 0:
+            return p_transform, None
+        start.append(idxs[0])
+        stop.append(idxs[-1] + 1)
+    start, stop = np.asarray(start), np.asarray(stop)
+
+    out_pixel_spacing = np.asarray(p_transform['pixel_spacing'], dtype='float32')
+    extent = (stop - start) * np.asarray(pixel_spacing) / out_pixel_spacing + 2. * margin
+    n_windows = np.maximum(1, np.ceil(extent / stride)).astype('int64')
+    patch_size = n_windows * stride + window_size - stride
+
+    p_canvas = dict(p_transform)
+    p_canvas['patch_size'] = tuple(int(s) for s in patch_size)
+    p_canvas['mm_patch_size'] = tuple(float(s) for s in patch_size * out_pixel_spacing)
+    return p_canvas, (start + stop - 1) / 2.
+
+
 def transform_patch3d(data, pixel_spacing, p_transform,
                       patch_center,
                       luna_origin,
                       luna_annotations=None,
                       p_transform_augment=None,
-                      world_coord_system=True):
+                      world_coord_system=True,
+                      random_state=None):
     mm_patch_size = np.asarray(p_transform['mm_patch_size'], dtype='float32')
     out_pixel_spacing = np.asarray(p_transform['pixel_spacing'])
 
@@ -257,7 +309,7 @@ def transform_patch3d(data, pixel_spacing, p_transform,
     tf_output_scale = affine_transform(scale=output_shape / mm_patch_size)
 
     if p_transform_augment:
-        augment_params_sample = sample_augmentation_parameters(p_transform_augment)
+        augment_params_sample = sample_augmentation_parameters(p_transform_augment, random_state)
         # print 'augmentation parameters', augment_params_sample
         tf_augment = affine_transform(translation=augment_params_sample.translation,
                                       rotation=augment_params_sample.rotation)
@@ -296,7 +348,8 @@ def transform_patch3d_ls(data, pixel_spacing, p_transform,
                       patch_center,
                       luna_origin,
                       p_transform_augment=None,
-                      world_coord_system=True):
+                      world_coord_system=True,
+                      random_state=None):
     mm_patch_size = np.asarray(p_transform['mm_patch_size'], dtype='float32')
     out_pixel_spacing = np.asarray(p_transform['pixel_spacing'])
 
@@ -320,7 +373,7 @@ def transform_patch3d_ls(data, pixel_spacing, p_transform,
     tf_output_scale = affine_transform(scale=output_shape / mm_patch_size)
 
     if p_transform_augment:
-        augment_params_sample = sample_augmentation_parameters(p_transform_augment)
+        augment_params_sample = sample_augmentation_parameters(p_transform_augment, random_state)
         # print 'augmentation parameters', augment_params_sample
         tf_augment = affine_transform(translation=augment_params_sample.translation,
                                       rotation=augment_params_sample.rotation)
@@ -343,54 +396,29 @@ def transform_patch3d_ls(data, pixel_spacing, p_transform,
 
 
 def transform_dsb_candidates(data, patch_centers, pixel_spacing, p_transform,
-                             p_transform_augment=None):
+                             p_transform_augment=None, out=None, random_state=None, snap_to_grid=False):
+    """
+    :param out: optional (len(patch_centers),) + patch_size array the patches are written into
+    :param random_state: RandomState the augmentations of all candidates are drawn from in turn
+    :param snap_to_grid: with order 1, round translation-only patches onto the voxel grid so they
+                         are cropped, see snap_to_voxel_grid. Meant for scans of the isotropic store
+    """
     input_shape = np.asarray(data.shape)
     output_shape = np.asarray(p_transform['patch_size'])
+    if out is None:
+        out = np.empty((len(patch_centers),) + tuple(output_shape), dtype=np.result_type(data.dtype, 'float32'))
 
-    patches_out = []
-    for zyxd in patch_centers:
+    # affine patches are collected and sampled in one batch per run of consecutive candidates
+    affine_idxs, affine_matrices = [], []
+    for i, zyxd in enumerate(patch_centers):
         if -1 in zyxd:
-            patch_out = np.zeros(output_shape)
+            out[i] = 0.
         elif 'affine_tf' in p_transform and not p_transform['affine_tf']:
             assert(output_shape[0] == output_shape[1])
             assert(output_shape[0] == output_shape[2])
 
             zyx = np.round(np.array(zyxd[:3])).astype('int32')
-
-            z_in = zyx[0] > output_shape[0]/2 and zyx[0] < input_shape[0]-output_shape[0]/2
-            y_in = zyx[1] > output_shape[1]/2 and zyx[1] < input_shape[1]-output_shape[1]/2
-            x_in = zyx[2] > output_shape[2]/2 and zyx[2] < input_shape[2]-output_shape[2]/2
-
-            patch_inside_tensor = z_in and y_in and x_in
-
-            if patch_inside_tensor:
-                patch_out = data[zyx[0]-output_shape[0]/2:zyx[0]+output_shape[0]/2,
-                                 zyx[1]-output_shape[1]/2:zyx[1]+output_shape[1]/2,
-                                 zyx[2]-output_shape[2]/2:zyx[2]+output_shape[2]/2] 
-            else:
-                data_pad = np.empty((input_shape[0]+output_shape[0], 
-                                     input_shape[1]+output_shape[1], 
-                                     input_shape[2]+output_shape[2]))
-
-                data_pad[0:output_shape[0]/2,:,:] = 0
-                data_pad[output_shape[0]/2+input_shape[0]:,:,:] = 0
-
-                data_pad[:,0:output_shape[1]/2,:] = 0
-                data_pad[:,output_shape[1]/2+input_shape[1]:,:] = 0
-
-                data_pad[:,:,0:output_shape[2]/2] = 0
-                data_pad[:,:,output_shape[2]/2+input_shape[2]:] = 0
-
-                data_pad[output_shape[0]/2:output_shape[0]/2+input_shape[0],
-                         output_shape[1]/2:output_shape[1]/2+input_shape[1],
-                         output_shape[2]/2:output_shape[2]/2+input_shape[2],] = data
-
-                #too slow data_pad = np.lib.pad(data, output_shape[0], mode='constant', constant_values = MIN_HU)
-
-                zyx_pad = zyx + output_shape/2
-                patch_out = data_pad[zyx_pad[0]-output_shape[0]/2:zyx_pad[0]+output_shape[0]/2,
-                                     zyx_pad[1]-output_shape[1]/2:zyx_pad[1]+output_shape[1]/2,
-                                     zyx_pad[2]-output_shape[2]/2:zyx_pad[2]+output_shape[2]/2] 
+            crop_patch(data, zyx - output_shape / 2, out[i])
         else:
             mm_patch_size = np.asarray(p_transform['mm_patch_size'], dtype='float32')
             out_pixel_spacing = np.asarray(p_transform['pixel_spacing'])
@@ -405,21 +433,140 @@ def transform_dsb_candidates(data, patch_centers, pixel_spacing, p_transform,
             tf_output_scale = affine_transform(scale=output_shape / mm_patch_size)
 
             if p_transform_augment:
-                augment_params_sample = sample_augmentation_parameters(p_transform_augment)
+                augment_params_sample = sample_augmentation_parameters(p_transform_augment, random_state)
                 tf_augment = affine_transform(translation=augment_params_sample.translation,
                                               rotation=augment_params_sample.rotation)
                 tf_total = tf_mm_scale.dot(tf_shift_center).dot(tf_augment).dot(tf_shift_uncenter).dot(tf_output_scale)
             else:
                 tf_total = tf_mm_scale.dot(tf_shift_center).dot(tf_shift_uncenter).dot(tf_output_scale)
 
-            patch_out = apply_affine_transform(data, tf_total, order=p_transform['order'], output_shape=output_shape)
-        
-        patches_out.append(patch_out[None, :, :, :])
-    return np.concatenate(patches_out, axis=0)
+            if snap_to_grid and p_transform['order'] == 1:
+                tf_total = snap_to_voxel_grid(tf_total)
+            if p_transform['order'] <= 1 and is_voxel_translation(tf_total):
+                crop_patch(data, tf_total[:3, 3], out[i])
+            else:
+                affine_idxs.append(i)
+                affine_matrices.append(tf_total)
+
+    run_start = 0
+    for k in xrange(1, len(affine_idxs) + 1):
+        if k == len(affine_idxs) or affine_idxs[k] != affine_idxs[k - 1] + 1:
+            i, j = affine_idxs[run_start], affine_idxs[k - 1] + 1
+            apply_affine_transforms(data, affine_matrices[run_start:k], order=p_transform['order'],
+                                    output_shape=output_shape, out=out[i:j])
+            run_start = k
+    return out
+
+
+def augmentation_extent_bound(p_transform_augment):
+    """
+    Elementwise bound on the absolute rotation matrix of the augmentation,
+    and the largest absolute translation along each axis.
+    """
+    sin_bound = []
+    for axis in ('z', 'y', 'x'):
+        max_angle = np.amax(np.abs(p_transform_augment.get('rotation_range_%s' % axis, [0., 0.])))
+        sin_bound.append(1. if max_angle >= 90. else math.sin(math.radians(max_angle)))
+    # |mx.my.mz| <= |mx|.|my|.|mz| with |cos| <= 1 and |sin| <= sin_bound
+    mz = np.array([[1., 0., 0.], [0., 1., sin_bound[0]], [0., sin_bound[0], 1.]])
+    my = np.array([[1., 0., sin_bound[1]], [0., 1., 0.], [sin_bound[1], 0., 1.]])
+    mx = np.array([[1., sin_bound[2], 0.], [sin_bound[2], 1., 0.], [0., 0., 1.]])
+    rotation_bound = mx.dot(my).dot(mz)
+    rotation_bound = np.maximum(rotation_bound, rotation_bound.T)
+
+    max_translation = np.array([np.amax(np.abs(p_transform_augment.get('translation_range_%s' % axis, [0., 0.])))
+                                for axis in ('z', 'y', 'x')])
+    return rotation_bound, max_translation
+
+
+def patch_centers_boxes(patch_centers, input_shape, pixel_spacing, p_transform, p_transform_augment=None):
+    """
+    Voxel boxes of the input regions the patches around every one of patch_centers
+    can sample from, including the rotation and translation augmentation.
+    Works for transform_dsb_candidates and transform_patch3d in voxel coordinates.
+    :return: (n, 2, 3) array of start, stop clipped to input_shape, padding rows are left out
+    """
+    input_shape = np.asarray(input_shape)
+    centers = np.array([zyxd[:3] for zyxd in patch_centers if -1 not in zyxd], dtype='float64').reshape(-1, 3)
+
+    if 'affine_tf' in p_transform and not p_transform['affine_tf']:
+        half_extent = np.asarray(p_transform['patch_size']) / 2.
+    else:
+        mm_half_extent = np.asarray(p_transform['mm_patch_size'], dtype='float64') / 2.
+        if p_transform_augment:
+            rotation_bound, max_translation = augmentation_extent_bound(p_transform_augment)
+            mm_half_extent = rotation_bound.dot(mm_half_extent + max_translation)
+        out_pixel_spacing = np.asarray(p_transform['pixel_spacing'])
+        half_extent = mm_half_extent * out_pixel_spacing / np.asarray(pixel_spacing)
+
+    # one voxel margin for the interpolation and the rounding
+    start = np.floor(centers - half_extent).astype('int64') - 1
+    stop = np.ceil(centers + half_extent).astype('int64') + 2
+    return np.clip(np.stack((start, stop), axis=1), 0, input_shape)
+
+
+def patch_centers_bounding_box(patch_centers, input_shape, pixel_spacing, p_transform,
+                               p_transform_augment=None):
+    """
+    Voxel bounding box of the patch_centers_boxes, the region the patches around
+    patch_centers can sample from.
+    :return: start, stop clipped to input_shape
+    """
+    boxes = patch_centers_boxes(patch_centers, input_shape, pixel_spacing, p_transform, p_transform_augment)
+    if len(boxes) == 0:
+        return np.zeros(3, dtype='int64'), np.zeros(3, dtype='int64')
+    start = boxes[:, 0].min(axis=0)
+    stop = boxes[:, 1].max(axis=0)
+    # even offsets, so np.round of the shifted centres rounds half to even the same way
+    start -= start % 2
+    return start, stop
+
+
+def shift_patch_centers(patch_centers, offset):
+    """
+    Moves patch centres into the coordinates of a volume cropped at offset,
+    padding rows (containing -1) are left untouched.
+    Rows are copied one by one, as padding rows can be shorter than the candidates.
+    :return: list of float64 rows
+    """
+    patch_centers = [np.array(zyxd, dtype='float64') for zyxd in patch_centers]
+    for zyxd in patch_centers:
+        if -1 not in zyxd:
+            zyxd[:3] -= offset
+    return patch_centers
+
+
+def transform_patch_centers(patch_centers, matrix):
+    """
+    Maps patch centres with an affine matrix, e.g. an inverse voxel_tf from
+    original voxels to the voxels of a resampled scan.
+    Padding rows (containing -1) are left untouched.
+    :return: list of float64 rows, see shift_patch_centers
+    """
+    patch_centers = [np.array(zyxd, dtype='float64') for zyxd in patch_centers]
+    for zyxd in patch_centers:
+        if -1 not in zyxd:
+            zyxd[:3] = matrix[:3, :3].dot(zyxd[:3]) + matrix[:3, 3]
+    return patch_centers
+
+
+def resample_scan(data, pixel_spacing, out_pixel_spacing=(1., 1., 1.), order=1):
+    """
+    Resamples a scan to out_pixel_spacing, the first voxels of both grids coincide.
+    :return: resampled scan, voxel_tf mapping voxels of the resampled scan to voxels
+             of data, with the convention of the tf_matrix outputs: input = voxel_tf.dot(output)
+    """
+    pixel_spacing = np.asarray(pixel_spacing, dtype='float64')
+    out_pixel_spacing = np.asarray(out_pixel_spacing, dtype='float64')
+    output_shape = np.round(np.asarray(data.shape) * pixel_spacing / out_pixel_spacing).astype('int64')
+    output_shape = tuple(np.maximum(output_shape, 1))
+    voxel_tf = affine_transform(scale=pixel_spacing / out_pixel_spacing)
+    data_out = apply_affine_transform(data, voxel_tf, order=order, output_shape=output_shape)
+    return data_out, voxel_tf
 
 
 def build_dsb_can_heatmap(data, candidates, pixel_spacing, p_transform,
-                             p_transform_augment=None):
+                             p_transform_augment=None, random_state=None):
 
     assert(candidates.shape[1]>3)
 
@@ -456,7 +603,7 @@ def build_dsb_can_heatmap(data, candidates, pixel_spacing, p_transform,
 
     # augmentation
     if p_transform_augment:
-        augment_params_sample = sample_augmentation_parameters(p_transform_augment)
+        augment_params_sample = sample_augmentation_parameters(p_transform_augment, random_state)
         tf_augment = affine_transform(translation=augment_params_sample.translation, rotation=augment_params_sample.rotation)
         heatmap = apply_affine_transform(heatmap, tf_augment, order=p_transform['heatmap_order'], output_shape=output_shape)
 
@@ -560,9 +707,105 @@ def affine_transform(scale=None, rotation=None, translation=None):
     return matrix
 
 
+def affine_input_bounding_box(matrix, input_shape, output_shape):
+    """
+    Voxel bounding box of the input that the output grid of an affine transform samples from.
+    The map is affine, so the extremes are reached in the corners of the output grid.
+    :return: start, stop clipped to input_shape
+    """
+    corners = np.array(list(itertools.product(*[(0, n - 1) for n in output_shape])), dtype='float64')
+    coords = corners.dot(matrix[:3, :3].T) + matrix[:3, 3]
+    # order 0 and 1 interpolation read at most one voxel beyond floor(coordinate)
+    start = np.floor(coords.min(axis=0)).astype('int64') - 1
+    stop = np.floor(coords.max(axis=0)).astype('int64') + 3
+    start = np.clip(start, 0, input_shape)
+    stop = np.clip(stop, 0, input_shape)
+    # axes that reach the far edge are not shifted, the offset then stays bit
+    # identical and so does the handling of samples on the edge of the volume
+    start[stop == np.asarray(input_shape)] = 0
+    return start, stop
+
+
+def crop_patch(data, start, out):
+    """
+    Copies data[start:start + out.shape] into out, the part of the patch
+    outside the volume is set to zero. Only the intersection is copied.
+    :param start: voxel index of the first corner of the patch, can lie outside data
+    :return: out
+    """
+    start = np.asarray(start, dtype='int64')
+    stop = start + out.shape
+    lo = np.maximum(start, 0)
+    hi = np.minimum(stop, data.shape)
+    if np.any(lo > start) or np.any(hi < stop):
+        out[...] = 0.
+    if np.all(hi > lo):
+        out[lo[0] - start[0]:hi[0] - start[0],
+            lo[1] - start[1]:hi[1] - start[1],
+            lo[2] - start[2]:hi[2] - start[2]] = data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]]
+    return out
+
+
+def apply_affine_transforms(_input, matrices, order=1, output_shape=None, out=None,
+                            max_chunk_voxels=2 ** 22):
+    """
+    Batched apply_affine_transform: the sampling coordinates of all matrices are
+    built at once and interpolated with one map_coordinates call per chunk.
+    :param out: optional (len(matrices),) + output_shape array the outputs are written into
+    :param max_chunk_voxels: bounds the size of the coordinate arrays of one chunk
+    """
+    output_shape = tuple(output_shape) if output_shape is not None else _input.shape
+    if out is None:
+        out = np.empty((len(matrices),) + output_shape, dtype=_input.dtype)
+    grid = np.indices(output_shape, dtype='float64').reshape(3, -1)
+    chunk_size = max(1, max_chunk_voxels // grid.shape[1])
+    for i in xrange(0, len(matrices), chunk_size):
+        m = np.asarray(matrices[i:i + chunk_size])
+        n = len(m)
+        # input = T.dot(output) + s for every matrix, coordinates get shape (3, n) + output_shape
+        coords = m[:, :3, :3].reshape(n * 3, 3).dot(grid).reshape(n, 3, -1)
+        coords += m[:, :3, 3, None]
+        coords = coords.transpose(1, 0, 2).reshape((3, n) + output_shape)
+        scipy.ndimage.map_coordinates(_input, coords, output=out[i:i + n], order=order)
+    return out
+
+
+def is_voxel_translation(matrix):
+    """
+    True when the affine transform only shifts the voxel grid by whole voxels,
+    e.g. for unaugmented patches of a scan already at the output pixel spacing.
+    """
+    return np.array_equal(matrix[:3, :3], np.eye(3)) and np.array_equal(matrix[:3, 3], np.round(matrix[:3, 3]))
+
+
+def snap_to_voxel_grid(matrix):
+    """
+    Rounds the shift of a translation-only transform to whole voxels, other transforms
+    are returned unchanged. The patch moves by at most half a voxel along each axis,
+    below the blur of the linear interpolation it replaces. Not for order 0, np.round
+    breaks ties differently from the nearest neighbour sampling of scipy.
+    """
+    if not np.array_equal(matrix[:3, :3], np.eye(3)):
+        return matrix
+    matrix = matrix.copy()
+    matrix[:3, 3] = np.round(matrix[:3, 3])
+    return matrix
+
+
 def apply_affine_transform(_input, matrix, order=1, output_shape=None):
     # output.dot(T) + s = input
     T = matrix[:3, :3]
     s = matrix[:3, 3]
+    if order <= 1 and output_shape is not None and is_voxel_translation(matrix):
+        # samples fall on voxel centres, so interpolation reduces to a crop
+        return crop_patch(_input, s, np.empty(output_shape, dtype=_input.dtype))
+    if order <= 1 and output_shape is not None:
+        # sample from the region the output can touch only, higher orders need
+        # the spline prefilter of the whole volume so they are left alone
+        start, stop = affine_input_bounding_box(matrix, _input.shape, output_shape)
+        if np.any(stop <= start):
+            return np.zeros(output_shape, dtype=_input.dtype)
+        _input = _input[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+        s = s - start
     return scipy.ndimage.interpolation.affine_transform(
         _input, matrix=T, offset=s, order=order, output_shape=output_shape)
@@ -20,7 +20,7 @@ outputs_path = predictions_dir + '/%s' % config_name
 pid2candidates_path = utils_lung.get_candidates_paths(outputs_path)
 pid2candidates = {}
 for k, v in pid2candidates_path.iteritems():
-    pid2candidates[k] = utils.load_pkl(v)
+    pid2candidates[k] = utils_lung.load_candidates(v)
 
 pid2annotations = utils_lung.read_luna_annotations(pathfinder.LUNA_LABELS_PATH)
 
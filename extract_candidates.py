@@ -0,0 +1,52 @@
+import sys
+import time
+import multiprocessing as mp
+import pathfinder
+import utils
+import candidate_store
+import candidate_extraction
+import heatmap_store
+
+# reruns the blob detection of a seg-scan stage from its stored heatmaps with other parameters,
+# in parallel over the patients, the candidates are saved in model-predictions/<outputs_name>
+# like test_seg_scan_dsb.py does (the LUNA detection flags of test_seg_scan.py are not recomputed)
+# usage: python extract_candidates.py <seg_scan_config_name> <outputs_name> [threshold] [min_sigma] [max_sigma] [n_processes] [detector]
+# detector is 'dog' or 'components', a threshold of 'default' takes the default of the detector
+if len(sys.argv) < 3:
+    sys.exit('Usage: extract_candidates.py <seg_scan_config_name> <outputs_name> '
+             '[threshold] [min_sigma] [max_sigma] [n_processes] [detector]')
+
+config_name = sys.argv[1]
+outputs_name = sys.argv[2]
+threshold = float(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3] != 'default' else None
+min_sigma = float(sys.argv[4]) if len(sys.argv) > 4 else 1.
+max_sigma = float(sys.argv[5]) if len(sys.argv) > 5 else 15.
+n_processes = int(sys.argv[6]) if len(sys.argv) > 6 else mp.cpu_count()
+detector = sys.argv[7] if len(sys.argv) > 7 else 'dog'
+
+predictions_dir = utils.get_dir_path('model-predictions', pathfinder.METADATA_PATH)
+heatmaps = heatmap_store.HeatmapStore(heatmap_store.store_path(predictions_dir + '/%s' % config_name))
+outputs_path = predictions_dir + '/%s' % outputs_name
+utils.auto_make_dir(outputs_path)
+
+
+def extract_patient(pid):
+    start_time = time.time()
+    heatmap, tf_matrix = heatmaps.read(pid)
+    blobs = candidate_extraction.detect_blobs(heatmap, detector, threshold, min_sigma, max_sigma)
+    blobs = candidate_extraction.blobs_to_original(blobs, tf_matrix)
+    candidate_store.save_candidates(blobs, outputs_path, pid)
+    return pid, len(blobs), time.time() - start_time
+
+
+pids = heatmaps.pids()
+print 'n patients', len(pids)
+print 'detector', detector, 'threshold', threshold, 'min_sigma', min_sigma, 'max_sigma', max_sigma
+
+start_time = time.time()
+pool = mp.Pool(n_processes)
+for idx, (pid, n_blobs, extraction_time) in enumerate(pool.imap_unordered(extract_patient, pids)):
+    print idx, pid, 'n blobs', n_blobs, 'time %.1f s' % extraction_time
+pool.close()
+pool.join()
+print 'Extraction took', utils.hms(time.time() - start_time)
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+import utils
+
+QUANTISATIONS = ('uint8', 'float16')
+
+
+def store_path(predictions_path):
+    """
+    The heatmaps of a stage live next to its model-predictions/<config> directory.
+    """
+    return predictions_path.rstrip('/') + '.heatmaps'
+
+
+class HeatmapStore(object):
+    """
+    On-disk store of segmentation heatmaps, one .npz per patient with the heatmap quantised to
+    uint8 (probabilities in 255 steps) or float16 and compressed in chunks of chunk_size slices,
+    together with the tf_matrix that maps heatmap voxels to voxels of the original scan.
+    Blob detection can be rerun from the store with other parameters without the network.
+    """
+
+    def __init__(self, path, quantisation='uint8', chunk_size=32):
+        if quantisation not in QUANTISATIONS:
+            raise ValueError('quantisation should be one of %s' % (QUANTISATIONS,))
+        self.path = path
+        self.quantisation = quantisation
+        self.chunk_size = chunk_size
+        utils.auto_make_dir(path)
+
+    def heatmap_path(self, pid):
+        return self.path + '/' + pid + '.npz'
+
+    def __contains__(self, pid):
+        return os.path.isfile(self.heatmap_path(pid))
+
+    def pids(self):
+        return sorted(f[:-len('.npz')] for f in os.listdir(self.path) if f.endswith('.npz'))
+
+    def write(self, pid, heatmap, tf_matrix):
+        """
+        :param heatmap: 3D heatmap with values in [0, 1]
+        """
+        if self.quantisation == 'uint8':
+            quantised = np.rint(np.clip(heatmap, 0., 1.) * 255.).astype('uint8')
+        else:
+            quantised = heatmap.astype('float16')
+        arrays = {'tf_matrix': tf_matrix,
+                  'shape': np.array(heatmap.shape),
+                  'quantisation': np.array(self.quantisation)}
+        for i, z in enumerate(xrange(0, heatmap.shape[0], self.chunk_size)):
+            arrays['chunk_%04d' % i] = quantised[z:z + self.chunk_size]
+
+        # write to a temporary file first so readers never see partial entries
+        tmp_path = self.heatmap_path(pid) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.rename(tmp_path, self.heatmap_path(pid))
+
+    def read(self, pid):
+        """
+        :return: float32 heatmap, tf_matrix
+        """
+        with np.load(self.heatmap_path(pid)) as f:
+            shape = tuple(f['shape'])
+            quantisation = str(f['quantisation'])
+            heatmap = np.empty(shape, dtype='float32')
+            n_chunks = len([k for k in f.files if k.startswith('chunk_')])
+            z = 0
+            for i in xrange(n_chunks):
+                chunk = f['chunk_%04d' % i]
+                heatmap[z:z + len(chunk)] = chunk
+                z += len(chunk)
+            tf_matrix = f['tf_matrix']
+        if quantisation == 'uint8':
+            heatmap /= 255.
+        return heatmap, tf_matrix
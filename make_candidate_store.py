@@ -0,0 +1,23 @@
+import sys
+import time
+import glob
+import utils
+import candidate_store
+
+# imports an existing model-predictions/<config> directory of <pid>.pkl candidates
+# into the candidate store of the stage, patients already in the store are skipped
+# usage: python make_candidate_store.py <predictions_path>
+if len(sys.argv) < 2:
+    sys.exit('Usage: make_candidate_store.py <predictions_path>')
+predictions_path = sys.argv[1]
+
+start_time = time.time()
+pkl_paths = sorted(glob.glob(predictions_path + '/*.pkl'))
+if not pkl_paths:
+    sys.exit('no candidates in %s' % predictions_path)
+n_columns = utils.load_pkl(pkl_paths[0]).shape[-1]
+store = candidate_store.CandidateStore(candidate_store.store_path(predictions_path), n_columns)
+n_imported = store.import_pkl_dir(predictions_path)
+print 'imported', n_imported, 'patients into', store.path
+print 'n patients in store', len(store.pids())
+print 'Import took', utils.hms(time.time() - start_time)
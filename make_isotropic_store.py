@@ -0,0 +1,37 @@
+import sys
+import time
+import numpy as np
+import utils
+import utils_lung
+import pathfinder
+import volume_store
+import data_transforms
+import data_iterators
+
+# one-time resampling of all DSB patients to isotropic voxels, the voxel_tf back to
+# the original voxels is saved in the metadata of every scan
+# usage: python make_isotropic_store.py [pixel_spacing_mm] [data_path] [store_path]
+pixel_spacing_out = float(sys.argv[1]) if len(sys.argv) > 1 else 1.
+data_path = sys.argv[2] if len(sys.argv) > 2 else pathfinder.DATA_PATH
+store_path = sys.argv[3] if len(sys.argv) > 3 else pathfinder.ISOTROPIC_STORE_PATH
+if not store_path:
+    raise ValueError('no ISOTROPIC_STORE_PATH given')
+
+store = volume_store.VolumeStore(store_path)
+patient_paths = utils_lung.get_patient_data_paths(data_path)
+print 'n patients', len(patient_paths)
+
+start_time = time.time()
+for idx, patient_path in enumerate(patient_paths):
+    pid = utils_lung.extract_pid_dir(patient_path)
+    if pid in store:
+        continue
+    img, pixel_spacing = data_iterators.read_dsb_scan(patient_path)
+    img_iso, voxel_tf = data_transforms.resample_scan(img, pixel_spacing, (pixel_spacing_out,) * 3)
+    store.write_scan(pid, img_iso, (pixel_spacing_out,) * 3,
+                     metadata={'voxel_tf': voxel_tf,
+                               'original_shape': img.shape,
+                               'original_pixel_spacing': np.array(pixel_spacing)})
+    print idx, pid, img.shape, '->', img_iso.shape
+
+print 'Resampling took', utils.hms(time.time() - start_time)
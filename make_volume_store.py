@@ -0,0 +1,28 @@
+import sys
+import time
+import utils
+import utils_lung
+import pathfinder
+import volume_store
+
+# one-time ingest of all DSB patients into the volume store
+# usage: python make_volume_store.py [data_path] [store_path]
+data_path = sys.argv[1] if len(sys.argv) > 1 else pathfinder.DATA_PATH
+store_path = sys.argv[2] if len(sys.argv) > 2 else pathfinder.VOLUME_STORE_PATH
+if not store_path:
+    raise ValueError('no VOLUME_STORE_PATH given')
+
+store = volume_store.VolumeStore(store_path)
+patient_paths = utils_lung.get_patient_data_paths(data_path)
+print 'n patients', len(patient_paths)
+
+start_time = time.time()
+for idx, patient_path in enumerate(patient_paths):
+    pid = utils_lung.extract_pid_dir(patient_path)
+    if pid in store:
+        continue
+    img, pixel_spacing = utils_lung.read_dicom_scan(patient_path)
+    store.write_scan(pid, img, pixel_spacing, metadata={'patient_path': patient_path})
+    print idx, pid, img.shape, pixel_spacing
+
+print 'Ingest took', utils.hms(time.time() - start_time)
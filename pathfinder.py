@@ -92,3 +92,9 @@ if not os.path.isfile(TIANCHI_LABELS_PATH):
 TIANCHI_DATA_PATH = paths['TIANCHI_DATA_PATH']
 
 TIANCHI_METADATA_PATH = paths['TIANCHI_METADATA_PATH']
+
+# optional store of preprocessed HU volumes, see volume_store.py and make_volume_store.py
+VOLUME_STORE_PATH = paths.get('VOLUME_STORE_PATH')
+
+# optional store of scans resampled to isotropic voxels, see make_isotropic_store.py
+ISOTROPIC_STORE_PATH = paths.get('ISOTROPIC_STORE_PATH')
@@ -0,0 +1,57 @@
+import time
+import multiprocessing
+import numpy as np
+import lung_segmentation
+import slice_morphology
+from sandbox import lung_segmentation_per_slice
+
+# time of the four lung segmenters on a synthetic chest scan: the old per-slice
+# loops as baseline, then the slice morphology for 1 thread and for all cores,
+# with the speedups over the baseline
+
+segmenters = ['segment_HU_scan', 'segment_HU_scan_frederic', 'segment_HU_scan_elias', 'segment_HU_scan_ira']
+
+
+def synthetic_scan(shape, rng):
+    """
+    Body of soft tissue in air with two ellipsoid lungs and small air pockets.
+    """
+    n_z, n_y, n_x = shape
+    zz, yy, xx = np.ogrid[:n_z, :n_y, :n_x]
+    x = np.full(shape, 40, dtype='int16')
+    body = ((yy - n_y / 2.) / (0.43 * n_y)) ** 2 + ((xx - n_x / 2.) / (0.47 * n_x)) ** 2 < 1
+    x[:, ~body[0]] = -1000
+    for center_x in (0.31 * n_x, 0.69 * n_x):
+        lung = (((yy - n_y / 2.) / (0.23 * n_y)) ** 2 + ((xx - center_x) / (0.14 * n_x)) ** 2
+                + ((zz - n_z / 2.) / (0.55 * n_z)) ** 2) < 1
+        x[lung] = -800
+    for _ in xrange(n_z * 10):
+        z, y, x_ = rng.randint(0, n_z), rng.randint(0, n_y - 8), rng.randint(0, n_x - 8)
+        x[z, y:y + rng.randint(1, 9), x_:x_ + rng.randint(1, 9)] = -700
+    return x
+
+
+def benchmark_lung_segmentation():
+    rng = np.random.RandomState(42)
+    n_threads = multiprocessing.cpu_count()
+    for scan_shape in [(100, 256, 256), (200, 512, 512)]:
+        x = synthetic_scan(scan_shape, rng)
+        print 'scan', scan_shape
+        for name in segmenters:
+            start_time = time.time()
+            mask_baseline = getattr(lung_segmentation_per_slice, name)(x)
+            time_baseline = time.time() - start_time
+            times = []
+            for n in sorted(set([1, n_threads])):
+                slice_morphology.set_n_threads(n)
+                start_time = time.time()
+                mask = getattr(lung_segmentation, name)(x)
+                times.append(time.time() - start_time)
+            assert np.array_equal(mask, mask_baseline)
+            print '%-26s per slice %.2f s, 1 thread %.2f s (%.1fx), %d threads %.2f s (%.1fx)' % (
+                name, time_baseline, times[0], time_baseline / times[0],
+                n_threads, times[-1], time_baseline / times[-1])
+
+
+if __name__ == '__main__':
+    benchmark_lung_segmentation()
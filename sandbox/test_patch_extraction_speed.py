@@ -0,0 +1,41 @@
+import time
+import numpy as np
+import data_transforms
+
+# per-patch latency of transform_dsb_candidates for growing scan sizes,
+# it should not depend on the size of the scan
+
+p_transform = {'patch_size': (48, 48, 48),
+               'mm_patch_size': (48, 48, 48),
+               'pixel_spacing': (1., 1., 1.),
+               'order': 1}
+p_transform_augment = {
+    'translation_range_z': [-5, 5],
+    'translation_range_y': [-5, 5],
+    'translation_range_x': [-5, 5],
+    'rotation_range_z': [-10, 10],
+    'rotation_range_y': [-10, 10],
+    'rotation_range_x': [-10, 10]
+}
+pixel_spacing = np.array([2.5, 0.7, 0.7])
+n_patches = 32
+
+
+def test_patch_extraction_speed():
+    rng = np.random.RandomState(42)
+    for scan_shape in [(100, 256, 256), (200, 512, 512), (400, 512, 512)]:
+        data = np.float32(rng.uniform(-1000., 400., scan_shape))
+        patch_centers = np.hstack((rng.uniform(0, 1, (n_patches, 3)) * scan_shape, np.ones((n_patches, 1))))
+
+        start_time = time.time()
+        x = data_transforms.transform_dsb_candidates(data=data,
+                                                     patch_centers=patch_centers,
+                                                     pixel_spacing=pixel_spacing,
+                                                     p_transform=p_transform,
+                                                     p_transform_augment=p_transform_augment)
+        time_per_patch = (time.time() - start_time) / n_patches
+        print 'scan', scan_shape, 'patches', x.shape, 'ms per patch %.2f' % (1000. * time_per_patch)
+
+
+if __name__ == '__main__':
+    test_patch_extraction_speed()
@@ -0,0 +1,130 @@
+import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import scipy.ndimage
+import skimage.morphology
+import skimage.segmentation
+
+# Slice by slice morphology of (z, y, x) scans. The structuring elements are flat in z, so one
+# 3D ndimage call gives the same result as the 2D operation on every slice. The scan is split
+# in slabs of consecutive slices that run in a pool of threads (ndimage releases the GIL),
+# and every slab writes its result into the preallocated output.
+# Operations without a 3D equivalent (convex hull, clear border) run per slice in the same pool.
+
+_n_threads = multiprocessing.cpu_count()
+_pool = None
+_pool_pid = None
+_selems = {}
+
+# 4-connected in the slice, nothing in z
+_FILL_STRUCTURE = np.zeros((3, 3, 3), dtype=bool)
+_FILL_STRUCTURE[1] = scipy.ndimage.generate_binary_structure(2, 1)
+
+
+def set_n_threads(n_threads):
+    global _n_threads, _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
+    _pool = None
+    _n_threads = n_threads
+
+
+def get_pool():
+    # a forked process inherits the pool object but not its threads, so it makes its own
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ThreadPool(_n_threads)
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def disk(radius):
+    """
+    Flat disk of (1, 2 * radius + 1, 2 * radius + 1), built once per radius.
+    """
+    if radius not in _selems:
+        _selems[radius] = skimage.morphology.disk(radius)[None].astype(bool)
+    return _selems[radius]
+
+
+def map_slabs(fun, x, out=None, dtype=None):
+    """
+    Runs fun on slabs of consecutive slices in the thread pool.
+    :param fun: fun(slab) returns the result of the slab, slabs must not depend on each other
+    :param out: array the result is written into, x itself for in place operations
+    :param dtype: dtype of a new out, by default the one of x
+    :return: out
+    """
+    if out is None:
+        out = np.empty(x.shape, dtype=x.dtype if dtype is None else dtype)
+    n_slabs = min(_n_threads, len(x))
+    bounds = np.linspace(0, len(x), n_slabs + 1).astype(int)
+
+    def run_slab(i):
+        out[bounds[i]:bounds[i + 1]] = fun(x[bounds[i]:bounds[i + 1]])
+
+    if n_slabs > 1:
+        get_pool().map(run_slab, xrange(n_slabs))
+    elif n_slabs == 1:
+        run_slab(0)
+    return out
+
+
+def _per_slice(fun, dtype, skip_empty=False):
+    def slab_fun(slab):
+        result = np.zeros(slab.shape, dtype=dtype)
+        for i in xrange(len(slab)):
+            if not skip_empty or np.any(slab[i]):
+                result[i] = fun(slab[i])
+        return result
+
+    return slab_fun
+
+
+def binary_fill_holes(x, out=None):
+    return map_slabs(lambda slab: scipy.ndimage.binary_fill_holes(slab, _FILL_STRUCTURE), x, out, bool)
+
+
+def binary_erosion(x, radius, out=None):
+    # border_value=True like skimage.morphology.binary_erosion
+    return map_slabs(lambda slab: scipy.ndimage.binary_erosion(slab, disk(radius), border_value=True),
+                     x, out, bool)
+
+
+def binary_dilation(x, radius, out=None):
+    return map_slabs(lambda slab: scipy.ndimage.binary_dilation(slab, disk(radius)), x, out, bool)
+
+
+def binary_opening(x, radius, out=None):
+    def opening(slab):
+        eroded = scipy.ndimage.binary_erosion(slab, disk(radius), border_value=True)
+        return scipy.ndimage.binary_dilation(eroded, disk(radius))
+
+    return map_slabs(opening, x, out, bool)
+
+
+def erosion(x, radius, out=None):
+    return map_slabs(lambda slab: scipy.ndimage.grey_erosion(slab, footprint=disk(radius)), x, out)
+
+
+def closing(x, radius, out=None):
+    def grey_closing(slab):
+        dilated = scipy.ndimage.grey_dilation(slab, footprint=disk(radius))
+        return scipy.ndimage.grey_erosion(dilated, footprint=disk(radius))
+
+    return map_slabs(grey_closing, x, out)
+
+
+def convex_hull(x, out=None):
+    """
+    Convex hull of every slice, slices without foreground stay empty.
+    """
+    return map_slabs(_per_slice(skimage.morphology.convex_hull_image, bool, skip_empty=True), x, out, bool)
+
+
+def clear_border(x, out=None):
+    """
+    Removes the foreground connected to the border of every slice.
+    """
+    return map_slabs(_per_slice(skimage.segmentation.clear_border, x.dtype), x, out)
@@ -0,0 +1,132 @@
+import time
+import numpy as np
+import lasagne as nn
+import buffering
+
+
+def window_nbytes(model):
+    """
+    Device memory one window takes in a forward pass: the input and the outputs of all layers.
+    """
+    n_values = 0
+    for layer in nn.layers.get_all_layers(model.l_out):
+        n_values += np.prod(layer.output_shape[1:])
+    return int(n_values) * np.dtype('float32').itemsize
+
+
+def windows_per_batch(model, memory_budget, max_windows=None):
+    """
+    :param memory_budget: bytes the windows of one batch may take, None to predict window by window
+    :return: number of windows that are gathered into one batch
+    """
+    if memory_budget is None:
+        return 1
+    n = max(1, int(memory_budget // window_nbytes(model)))
+    return min(n, max_windows) if max_windows else n
+
+
+class WindowedPredictor(object):
+    """
+    Runs a fully convolutional patch model over a scan with overlapping windows. The output
+    of a window of window_size voxels is its central cube of stride voxels, so the predictions
+    of neighbouring windows tile the scan.
+    Windows are gathered into batches of batch_size windows per call of the compiled function,
+    and the next batch is sliced from the scan in a thread while the model runs on the current one.
+    """
+
+    def __init__(self, predict_fun, x_shared, window_size, stride, batch_size=1):
+        """
+        :param predict_fun: compiled function without inputs that predicts x_shared
+        :param batch_size: windows per call, 1 is the unbatched path
+        """
+        self.predict_fun = predict_fun
+        self.x_shared = x_shared
+        self.window_size = window_size
+        self.stride = stride
+        self.batch_size = batch_size
+        self.last_stats = None
+
+    def window_grid(self, scan_shape):
+        """
+        :return: number of windows along z, y and x of a scan
+        """
+        return tuple((s - self.window_size) / self.stride + 1 for s in scan_shape)
+
+    def windows(self, scan_shape):
+        n_z, n_y, n_x = self.window_grid(scan_shape)
+        return [(iz, iy, ix) for iz in xrange(n_z) for iy in xrange(n_y) for ix in xrange(n_x)]
+
+    def lung_windows(self, scan_shape, lung_mask):
+        """
+        Windows whose output cube has lung voxels, the predictions of the others are
+        masked out anyway. The predictions are centred in the scan like the padding
+        of the prediction scripts does.
+        :param lung_mask: (1, 1) + scan shape mask
+        """
+        s = self.stride
+        grid = self.window_grid(scan_shape)
+        offset = (np.asarray(scan_shape) - np.asarray(grid) * s) / 2
+        lung_mask = lung_mask[0, 0]
+        windows = []
+        for iz, iy, ix in self.windows(scan_shape):
+            z, y, x = offset + (iz * s, iy * s, ix * s)
+            if np.any(lung_mask[z:z + s, y:y + s, x:x + s]):
+                windows.append((iz, iy, ix))
+        return windows
+
+    def generate_batches(self, x, windows):
+        w, s = self.window_size, self.stride
+        for pos in xrange(0, len(windows), self.batch_size):
+            windows_batch = windows[pos:pos + self.batch_size]
+            x_batch = np.empty((len(windows_batch),) + x.shape[1:2] + (w, w, w), dtype='float32')
+            for i, (iz, iy, ix) in enumerate(windows_batch):
+                x_batch[i] = x[0, :, iz * s:iz * s + w, iy * s:iy * s + w, ix * s:ix * s + w]
+            yield windows_batch, x_batch
+
+    def predict(self, x, lung_mask=None, out=None):
+        """
+        :param x: (1, n_channels) + scan shape input of the model
+        :param lung_mask: skip the windows without lung voxels in their output, their predictions
+                          are left at zero, which is exact for predictions multiplied by the mask
+        :param out: (1, 1) + scan shape array to write the predictions into, centred in the scan
+                    like the padding of the prediction scripts and with zeros around them
+        :return: (1, 1) + window grid * stride predictions, or out
+        """
+        s = self.stride
+        n_z, n_y, n_x = self.window_grid(x.shape[2:])
+        if out is None:
+            predictions_scan = np.zeros((1, 1, n_z * s, n_y * s, n_x * s))
+        else:
+            out[...] = 0.
+            z, y, x_ = (np.asarray(x.shape[2:]) - np.asarray((n_z, n_y, n_x)) * s) / 2
+            predictions_scan = out[:, :, z:z + n_z * s, y:y + n_y * s, x_:x_ + n_x * s]
+        n_windows = n_z * n_y * n_x
+        if lung_mask is None:
+            windows = self.windows(x.shape[2:])
+        else:
+            windows = self.lung_windows(x.shape[2:], lung_mask)
+
+        start_time = time.time()
+        n_batches = 0
+        for windows_batch, x_batch in buffering.buffered_gen_threaded(self.generate_batches(x, windows),
+                                                                      buffer_size=2):
+            self.x_shared.set_value(x_batch)
+            predictions_batch = self.predict_fun()
+            for i, (iz, iy, ix) in enumerate(windows_batch):
+                predictions_scan[0, 0, iz * s:(iz + 1) * s, iy * s:(iy + 1) * s, ix * s:(ix + 1) * s] = \
+                    predictions_batch[i, 0]
+            n_batches += 1
+
+        self.last_stats = {'n_windows': len(windows), 'n_skipped': n_windows - len(windows),
+                           'n_batches': n_batches,
+                           'batch_size': min(self.batch_size, max(len(windows), 1)),
+                           'time': time.time() - start_time}
+        return predictions_scan if out is None else out
+
+    def timing_summary(self):
+        stats = self.last_stats
+        path = 'batched (%d windows per call)' % stats['batch_size'] if stats['batch_size'] > 1 else 'unbatched'
+        n_total = stats['n_windows'] + stats['n_skipped']
+        return '%s: %d windows in %d calls, %.2f s, %.3f s per window, %.1f%% of %d windows skipped' % (
+            path, stats['n_windows'], stats['n_batches'], stats['time'],
+            stats['time'] / max(stats['n_windows'], 1), 100. * stats['n_skipped'] / max(n_total, 1), n_total)
@@ -4,6 +4,7 @@ import numpy as np
 import theano
 import pathfinder
 import utils
+import candidate_store
 from configuration import config, set_configuration
 from utils_plots import plot_slice_3d_3
 import theano.tensor as T
@@ -66,4 +67,4 @@ for k in pid2candidates.iterkeys():
     candidates = np.asarray(pid2candidates[k])
     candidates_wo_dupes = utils_lung.filter_close_neighbors(candidates)
     a = np.asarray(sorted(candidates_wo_dupes, key=lambda x: x[-1], reverse=True))
-    utils.save_pkl(a, outputs_path + '/%s.pkl' % k)
+    candidate_store.save_candidates(a, outputs_path, k)
@@ -6,6 +6,7 @@ import os
 
 import pathfinder
 import utils
+import candidate_store
 from configuration import config, set_configuration
 from utils_plots import plot_slice_3d_3
 import theano.tensor as T
@@ -66,7 +67,7 @@ if tta == 'tta':
             print patients_count, prev_pid, len(candidates)
             candidates = np.asarray(candidates)
             a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
-            utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
+            candidate_store.save_candidates(a, outputs_path, prev_pid)
             print 'saved predictions'
             patients_count += 1
             candidates = []
@@ -92,7 +93,7 @@ if tta == 'tta':
     print patients_count, prev_pid, len(candidates)
     candidates = np.asarray(candidates)
     a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
-    utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
+    candidate_store.save_candidates(a, outputs_path, prev_pid)
     print 'saved predictions'
 else:
     data_iterator = config().data_iterator
@@ -114,7 +115,7 @@ else:
             print patients_count, prev_pid, len(candidates)
             candidates = np.asarray(candidates)
             a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
-            utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
+            candidate_store.save_candidates(a, outputs_path, prev_pid)
             print 'saved predictions'
             patients_count += 1
             candidates = []
@@ -131,5 +132,5 @@ else:
     print patients_count, prev_pid, len(candidates)
     candidates = np.asarray(candidates)
     a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
-    utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
+    candidate_store.save_candidates(a, outputs_path, prev_pid)
     print 'saved predictions'
@@ -6,6 +6,7 @@ import os
 
 import pathfinder
 import utils
+import candidate_store
 from configuration import config, set_configuration
 from utils_plots import plot_slice_3d_3
 import theano.tensor as T
@@ -63,7 +64,7 @@ for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
     if pid != prev_pid and prev_pid is not None:
         print patients_count, prev_pid, len(candidates)
         candidates = np.asarray(candidates)
-        utils.save_pkl(candidates, outputs_path + '/%s.pkl' % prev_pid)
+        candidate_store.save_candidates(candidates, outputs_path, prev_pid)
         patients_count += 1
         candidates = []
 
@@ -82,4 +83,4 @@ for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
 # save the last one
 print patients_count, prev_pid, len(candidates)
 candidates = np.asarray(candidates)
-utils.save_pkl(candidates, outputs_path + '/%s.pkl' % prev_pid)
+candidate_store.save_candidates(candidates, outputs_path, prev_pid)
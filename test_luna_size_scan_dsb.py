@@ -6,6 +6,7 @@ import os
 
 import pathfinder
 import utils
+import candidate_store
 from configuration import config, set_configuration
 from utils_plots import plot_slice_3d_3
 import theano.tensor as T
@@ -65,7 +66,7 @@ for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
         candidates = np.asarray(candidates)
         a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
         print 'max malignancies', a[:10,-1]
-        utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
+        candidate_store.save_candidates(a, outputs_path, prev_pid)
         print 'saved predictions'
         patients_count += 1
         candidates = []
@@ -87,5 +88,5 @@ for n, (x, candidate_zyxd, id) in enumerate(data_iterator.generate()):
 print patients_count, prev_pid, len(candidates)
 candidates = np.asarray(candidates)
 a = np.asarray(sorted(candidates, key=lambda x: x[-1], reverse=True))
-utils.save_pkl(a, outputs_path + '/%s.pkl' % prev_pid)
+candidate_store.save_candidates(a, outputs_path, prev_pid)
 print 'saved predictions'
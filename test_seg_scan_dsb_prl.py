@@ -4,34 +4,32 @@ import numpy as np
 import theano
 import pathfinder
 import utils
+import candidate_store
 from configuration import config, set_configuration
 import theano.tensor as T
-import blobs_detection
 import logger
 import time
-import multiprocessing as mp
+import candidate_extraction
+import heatmap_store
 import buffering
+import sliding_window
 
 
 def extract_candidates(predictions_scan, tf_matrix, pid, outputs_path):
+    if heatmaps is not None:
+        heatmaps.write(pid, predictions_scan[0, 0], tf_matrix)
     print 'computing blobs'
     start_time = time.time()
-    blobs = blobs_detection.blob_dog(predictions_scan[0, 0], min_sigma=1, max_sigma=15, threshold=0.1)
+    blobs = candidate_extraction.detect_blobs(predictions_scan[0, 0], getattr(config(), 'blob_detector', 'dog'),
+                                              getattr(config(), 'blob_threshold', None))
     print 'blobs computation time:', (time.time() - start_time) / 60.
     print 'n blobs detected:', blobs.shape[0]
 
-    blobs_original_voxel_coords = []
-    for j in xrange(blobs.shape[0]):
-        blob_j = np.append(blobs[j, :3], [1])
-        blob_j_original = tf_matrix.dot(blob_j)
-        blobs_original_voxel_coords.append(blob_j_original)
-
-    blobs = np.asarray(blobs_original_voxel_coords)
+    blobs = candidate_extraction.blobs_to_original(blobs, tf_matrix)
     print blobs.shape
-    utils.save_pkl(blobs, outputs_path + '/%s.pkl' % pid)
+    candidate_store.save_candidates(blobs, outputs_path, pid)
 
 
-jobs = []
 theano.config.warn_float64 = 'raise'
 
 if len(sys.argv) < 3:
@@ -53,6 +51,18 @@ logs_dir = utils.get_dir_path('logs', pathfinder.METADATA_PATH)
 sys.stdout = logger.Logger(logs_dir + '/%s.log' % config_name)
 sys.stderr = sys.stdout
 
+# optionally keep the heatmaps, quantised to heatmap_quantisation, to rerun the blob detection
+# with other parameters by extract_candidates.py
+heatmaps = None
+if getattr(config(), 'heatmap_quantisation', None):
+    heatmaps = heatmap_store.HeatmapStore(heatmap_store.store_path(outputs_path), config().heatmap_quantisation)
+
+# long-lived blob extraction workers, fed with heatmaps through heatmap_memory bytes of shared memory
+extraction_pool = candidate_extraction.ExtractionPool(extract_candidates,
+                                                      n_workers=getattr(config(), 'n_extraction_workers', 3),
+                                                      slot_shape=(1, 1) + config().p_transform['patch_size'],
+                                                      memory_budget=getattr(config(), 'heatmap_memory', 2 * 1024 ** 3))
+
 # builds model and sets its parameters
 model = config().build_model()
 
@@ -73,6 +83,13 @@ get_predictions_patch = theano.function([],
                                         givens=givens,
                                         on_unused_input='ignore')
 
+# windows are predicted in batches that fit in the window_batch_memory of the config
+window_batch_size = sliding_window.windows_per_batch(model, getattr(config(), 'window_batch_memory', None),
+                                                     n_windows ** 3)
+predictor = sliding_window.WindowedPredictor(get_predictions_patch, x_shared, window_size, stride,
+                                             batch_size=window_batch_size)
+print 'windows per batch', window_batch_size
+
 data_iterator = config().data_iterators[data_iterator_part]
 
 print
@@ -85,26 +102,11 @@ for n, (x, lung_mask, tf_matrix, pid) in enumerate(
     print '-------------------------------------'
     print n, pid
 
-    predictions_scan = np.zeros((1, 1, n_windows * stride, n_windows * stride, n_windows * stride))
-
-    for iz in xrange(n_windows):
-        for iy in xrange(n_windows):
-            for ix in xrange(n_windows):
-                start_time_patch = time.time()
-                x_shared.set_value(x[:, :, iz * stride:(iz * stride) + window_size,
-                                   iy * stride:(iy * stride) + window_size,
-                                   ix * stride:(ix * stride) + window_size])
-                predictions_patch = get_predictions_patch()
-
-                predictions_scan[0, 0,
-                iz * stride:(iz + 1) * stride,
-                iy * stride:(iy + 1) * stride,
-                ix * stride:(ix + 1) * stride] = predictions_patch
-
-    if predictions_scan.shape != x.shape:
-        pad_width = (np.asarray(x.shape) - np.asarray(predictions_scan.shape)) / 2
-        pad_width = [(p, p) for p in pad_width]
-        predictions_scan = np.pad(predictions_scan, pad_width=pad_width, mode='constant')
+    # the heatmap is written straight into a shared memory slot of the extraction pool
+    slot_id, predictions_scan = extraction_pool.acquire(x.shape)
+    # windows without lung voxels are masked out below, so they are not predicted
+    predictor.predict(x, lung_mask, out=predictions_scan)
+    print predictor.timing_summary()
 
     if lung_mask is not None:
         predictions_scan *= lung_mask
@@ -112,13 +114,6 @@ for n, (x, lung_mask, tf_matrix, pid) in enumerate(
     print 'saved plot'
     print 'time since start:', (time.time() - start_time) / 60.
 
-    jobs = [job for job in jobs if job.is_alive]
-    if len(jobs) >= 3:
-        jobs[0].join()
-        del jobs[0]
-    jobs.append(
-        mp.Process(target=extract_candidates, args=(predictions_scan, tf_matrix, pid, outputs_path)))
-    jobs[-1].daemon = True
-    jobs[-1].start()
+    extraction_pool.submit(pid, slot_id, predictions_scan, tf_matrix, pid, outputs_path)
 
-for job in jobs: job.join()
+extraction_pool.close()
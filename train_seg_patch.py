@@ -13,6 +13,7 @@ import utils
 import logger
 import theano.tensor as T
 import buffering
+import data_iterators
 from configuration import config, set_configuration
 import pathfinder
 
@@ -116,9 +117,10 @@ start_time = time.time()
 prev_time = start_time
 tmp_losses_train = []
 
-# use buffering.buffered_gen_threaded()#开始获取数据训练，训练数据的来源：train_data_iterator.generate()
-for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in izip(chunk_idxs, buffering.buffered_gen_threaded(
-        train_data_iterator.generate())):
+# use buffering.buffered_gen_threaded(), or a pool of config().n_data_workers processes#开始获取数据训练，训练数据的来源：train_data_iterator.generate()
+for chunk_idx, (x_chunk_train, y_chunk_train, id_train) in izip(chunk_idxs, data_iterators.buffered_generate(
+        train_data_iterator, n_workers=getattr(config(), 'n_data_workers', 0),
+        slot_nbytes=getattr(config(), 'data_slot_bytes', None))):
     if chunk_idx in learning_rate_schedule:
         lr = np.float32(learning_rate_schedule[chunk_idx])
         print '  setting learning rate to %.7f' % lr
@@ -8,7 +8,17 @@ import os
 from collections import defaultdict
 import cPickle as pickle
 import glob
+from multiprocessing.pool import ThreadPool
 import utils
+import candidate_store
+
+# number of threads used to read and decode the slices of a DICOM scan
+DICOM_READ_THREADS = 8
+_dicom_pool = None
+_dicom_pool_pid = None
+
+# which series to keep when a patient folder holds several: 'most_slices' or 'thinnest'
+DICOM_SERIES_POLICY = 'most_slices'
 
 
 def read_pkl(path):
@@ -63,14 +73,35 @@ def extract_pid_filename(file_path, replace_str='.mhd'):
 
 
 def get_candidates_paths(path):
+    """
+    :return: dict of pid to the candidates of the patients with a <pid>.pkl, the path or, when the
+             candidate store of the stage holds all of them, a StoredCandidates handle.
+             Load either with load_candidates.
+    """
     id2candidates_path = {}
     file_paths = sorted(glob.glob(path + '/*.pkl'))
     for p in file_paths:
         pid = extract_pid_filename(p, '.pkl')
         id2candidates_path[pid] = p
+
+    if os.path.isfile(candidate_store.store_path(path)):
+        id2stored = candidate_store.CandidateStore(candidate_store.store_path(path)).id2candidates()
+        if set(id2candidates_path.keys()) <= set(id2stored.keys()):
+            # the store can hold patients of earlier runs or other splits
+            return dict((pid, id2stored[pid]) for pid in id2candidates_path)
     return id2candidates_path
 
 
+def load_candidates(candidates_path, top_k=None):
+    """
+    :param candidates_path: value of the dict returned by get_candidates_paths
+    """
+    if isinstance(candidates_path, candidate_store.StoredCandidates):
+        return candidates_path.load(top_k)
+    candidates = utils.load_pkl(candidates_path)
+    return candidates if top_k is None else candidates[:top_k]
+
+
 def get_patient_data(patient_data_path):
     slice_paths = os.listdir(patient_data_path)
     sid2data = {}
@@ -83,16 +114,108 @@ def get_patient_data(patient_data_path):
     return sid2data, sid2metadata
 
 
-def ct2HU(x, metadata):
-    x = metadata['RescaleSlope'] * x + metadata['RescaleIntercept']
+def ct2HU(x, metadata, out=None):
+    """
+    :param out: if given, the result is written into this array
+    """
+    if out is None:
+        x = metadata['RescaleSlope'] * x + metadata['RescaleIntercept']
+    else:
+        x = np.multiply(x, metadata['RescaleSlope'], out=out)
+        x += metadata['RescaleIntercept']
     x[x < -1000] = -1000
     return x
 
 
-def read_dicom_scan(patient_data_path):
-    sid2data, sid2metadata = get_patient_data(patient_data_path)
+def read_dicom_header(path):
+    """
+    Parses only the tags needed to build the scan, the pixel data
+    is deferred and read from disk when it is accessed.
+    """
+    d = dicom.read_file(path, defer_size=1024)
+    metadata = {}
+    metadata['InstanceNumber'] = int(d.InstanceNumber)
+    metadata['PixelSpacing'] = np.float32(d.PixelSpacing)
+    metadata['ImageOrientationPatient'] = np.float32(d.ImageOrientationPatient)
+    try:
+        metadata['SliceLocation'] = np.float32(d.SliceLocation)
+    except:
+        metadata['SliceLocation'] = None
+    metadata['ImagePositionPatient'] = np.float32(d.ImagePositionPatient)
+    metadata['Rows'] = int(d.Rows)
+    metadata['Columns'] = int(d.Columns)
+    metadata['RescaleSlope'] = float(d.RescaleSlope)
+    metadata['RescaleIntercept'] = float(d.RescaleIntercept)
+    metadata['SeriesInstanceUID'] = getattr(d, 'SeriesInstanceUID', None)
+    metadata['AcquisitionNumber'] = getattr(d, 'AcquisitionNumber', None)
+    return d, metadata
+
+
+def group_scan_series(sid2metadata):
+    """
+    Groups slices by SeriesInstanceUID. A series with repeated slice positions
+    holds several acquisitions, those are split by AcquisitionNumber.
+    :return: list of lists of slice ids
+    """
+    uid2sids = defaultdict(list)
+    for sid, metadata in sid2metadata.iteritems():
+        uid2sids[metadata['SeriesInstanceUID']].append(sid)
+
+    groups = []
+    for uid in sorted(uid2sids.keys()):
+        sids = uid2sids[uid]
+        positions = [np.round(get_slice_position(sid2metadata[sid]), 2) for sid in sids]
+        if len(set(positions)) < len(positions):
+            acquisition2sids = defaultdict(list)
+            for sid in sids:
+                acquisition2sids[sid2metadata[sid]['AcquisitionNumber']].append(sid)
+            groups.extend(acquisition2sids[a] for a in sorted(acquisition2sids.keys()))
+        else:
+            groups.append(sids)
+    return groups
+
+
+def select_scan_series(sid2metadata, policy=None):
+    """
+    Picks one series out of the slices of a patient folder.
+    :param policy: 'most_slices' keeps the largest series, 'thinnest' the one
+    with the smallest slice spacing, the other criterion breaks ties,
+    None uses DICOM_SERIES_POLICY at the time of the call
+    :return: slice ids of the selected series
+    """
+    if policy is None:
+        policy = DICOM_SERIES_POLICY
+    groups = group_scan_series(sid2metadata)
+    if len(groups) == 1:
+        return groups[0]
+
+    def z_spacing(sids):
+        positions = np.sort([get_slice_position(sid2metadata[sid]) for sid in sids])
+        return np.median(np.diff(positions)) if len(sids) > 1 else np.inf
+
+    def last_instance(sids):
+        return max(sid2metadata[sid]['InstanceNumber'] for sid in sids)
+
+    if policy == 'most_slices':
+        key = lambda g: (len(g), -z_spacing(g), last_instance(g))
+    elif policy == 'thinnest':
+        key = lambda g: (-z_spacing(g), len(g), last_instance(g))
+    else:
+        raise ValueError('unknown series policy %s' % policy)
+
+    selected = max(groups, key=key)
+    print 'This patient has %d series, kept one with %d slices' % (len(groups), len(selected))
+    return selected
+
+
+def sort_scan_slices(sid2metadata):
+    """
+    Orders the slices along the scan axis. Interleaved slices of a second
+    series that could not be told apart by the headers are dropped.
+    :return: sorted slice ids, pixel spacing of the scan
+    """
     sid2position = {}
-    for sid in sid2data.keys():
+    for sid in sid2metadata.keys():
         sid2position[sid] = get_slice_position(sid2metadata[sid])
     sids_sorted = sorted(sid2position.items(), key=lambda x: x[1])
     sids_sorted = [s[0] for s in sids_sorted]
@@ -120,10 +243,106 @@ def read_dicom_scan(patient_data_path):
     pixel_spacing = np.array((z_pixel_spacing[0],
                               sid2metadata[sids_sorted[0]]['PixelSpacing'][0],
                               sid2metadata[sids_sorted[0]]['PixelSpacing'][1]))
+    return sids_sorted, pixel_spacing
+
+
+def get_dicom_pool():
+    # the pool is shared by all scans, starting threads for each scan is too slow
+    # a forked process inherits the pool object but not its threads, so it makes its own
+    global _dicom_pool, _dicom_pool_pid
+    if _dicom_pool is None or _dicom_pool_pid != os.getpid():
+        _dicom_pool = ThreadPool(DICOM_READ_THREADS)
+        _dicom_pool_pid = os.getpid()
+    return _dicom_pool
+
 
-    img = np.stack([ct2HU(sid2data[sid], sid2metadata[sid]) for sid in sids_sorted])
+def read_dicom_scan_headers(patient_data_path, series_policy=None):
+    """
+    Parses the headers of a patient folder with a thread pool and selects one series.
+    :return: (dataset, metadata) pairs of the sorted slices, pixel spacing
+    """
+    pool = get_dicom_pool()
+    slice_paths = [patient_data_path + '/' + s for s in os.listdir(patient_data_path)]
+    headers = pool.map(read_dicom_header, slice_paths)
+    sid2metadata = dict((sid, metadata) for sid, (_, metadata) in enumerate(headers))
+    series_sids = select_scan_series(sid2metadata, series_policy)
+    sid2metadata = dict((sid, sid2metadata[sid]) for sid in series_sids)
+    sids_sorted, pixel_spacing = sort_scan_slices(sid2metadata)
+    return [headers[sid] for sid in sids_sorted], pixel_spacing
 
-    return img, pixel_spacing
+
+def decode_dicom_slices(slice_headers, y_slice=slice(None), x_slice=slice(None), dtype='float32'):
+    """
+    Decodes the slices in parallel straight into a preallocated volume
+    and converts them to HU in place.
+    :param y_slice, x_slice: region of each slice that is kept
+    """
+    if not slice_headers:
+        return np.zeros((0, 0, 0), dtype=dtype)
+    _, md = slice_headers[0]
+    n_rows = len(xrange(*y_slice.indices(md['Rows'])))
+    n_columns = len(xrange(*x_slice.indices(md['Columns'])))
+    img = np.empty((len(slice_headers), n_rows, n_columns), dtype=dtype)
+
+    def decode_slice(i):
+        d, metadata = slice_headers[i]
+        ct2HU(d.pixel_array[y_slice, x_slice], metadata, out=img[i])
+
+    get_dicom_pool().map(decode_slice, range(len(slice_headers)))
+    return img
+
+
+def load_dicom_volume(patient_data_path, dtype='float32', series_policy=None):
+    """
+    Fast DICOM ingest: headers are parsed with a thread pool and grouped
+    into series, then only the slices of the selected series are decoded,
+    again in parallel, straight into a preallocated volume and converted
+    to HU in place.
+    :return: HU volume, pixel spacing
+    """
+    slice_headers, pixel_spacing = read_dicom_scan_headers(patient_data_path, series_policy)
+    return decode_dicom_slices(slice_headers, dtype=dtype), pixel_spacing
+
+
+def load_dicom_volume_roi(patient_data_path, roi_fun, dtype='float32', series_policy=None,
+                          fill_value=-1000.):
+    """
+    Partial DICOM read: only the slices and the in-plane region of the roi are decoded.
+    With boxes, only the slices of the boxes are decoded, each one in the in-plane
+    bounding box of the boxes it crosses.
+    :param roi_fun: maps (scan shape, pixel spacing) to the voxel (start, stop) of the roi and
+                    the (n, 2, 3) boxes in it that are read, None reads the whole roi
+    :param fill_value: value of the voxels of the roi outside the boxes
+    :return: HU volume of the roi, pixel spacing, start of the roi
+    """
+    slice_headers, pixel_spacing = read_dicom_scan_headers(patient_data_path, series_policy)
+    _, md = slice_headers[0]
+    start, stop, boxes = roi_fun((len(slice_headers), md['Rows'], md['Columns']), pixel_spacing)
+    if boxes is None:
+        img = decode_dicom_slices(slice_headers[start[0]:stop[0]],
+                                  slice(start[1], stop[1]), slice(start[2], stop[2]), dtype=dtype)
+        return img, pixel_spacing, start
+
+    img = np.full(np.maximum(stop - start, 0), fill_value, dtype=dtype)
+    boxes = np.asarray(boxes).reshape(-1, 2, 3)
+    slice_regions = []
+    for z in xrange(start[0], stop[0]):
+        crossing = boxes[(boxes[:, 0, 0] <= z) & (z < boxes[:, 1, 0])]
+        if len(crossing):
+            slice_regions.append((z, crossing[:, 0, 1:].min(axis=0), crossing[:, 1, 1:].max(axis=0)))
+
+    def decode_slice(region):
+        z, (y0, x0), (y1, x1) = region
+        d, metadata = slice_headers[z]
+        ct2HU(d.pixel_array[y0:y1, x0:x1], metadata,
+              out=img[z - start[0], y0 - start[1]:y1 - start[1], x0 - start[2]:x1 - start[2]])
+
+    get_dicom_pool().map(decode_slice, slice_regions)
+    return img, pixel_spacing, start
+
+
+def read_dicom_scan(patient_data_path, series_policy=None):
+    return load_dicom_volume(patient_data_path, series_policy=series_policy)
 
 
 def sort_slices_position(patient_data):
@@ -215,6 +434,47 @@ def read_patient_annotations_luna(pid, directory):
     return pickle.load(open(os.path.join(directory,pid+'.pkl'),"rb"))
 
 
+class LunaNoduleIndex(object):
+    """
+    Radiologist annotations of the LUNA nodules, read once per patient and kept in memory.
+    Per patient the nodule centroids are an (n, 3) zyx array with an (n, n_characteristics)
+    matrix next to it, so the nodules close to a candidate are found with one vectorised distance.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pid2nodules = {}
+
+    def load(self, pid):
+        if pid not in self.pid2nodules:
+            centroids, nodule_keys, characteristics = [], [], []
+            for doctor in read_patient_annotations_luna(pid, self.directory):
+                for nodule in doctor:
+                    if 'centroid_xyz' in nodule:
+                        centroids.append(nodule['centroid_xyz'][::-1])
+                        nodule_keys.append(nodule['characteristics'].keys())
+                        characteristics.append(nodule['characteristics'])
+            names = sorted(set().union(*nodule_keys))
+            values = np.array([[float(c[n]) if n in c else np.nan for n in names] for c in characteristics],
+                              dtype='float64').reshape(len(characteristics), len(names))
+            centroids = np.array(centroids, dtype='float64').reshape(-1, 3)
+            self.pid2nodules[pid] = (centroids, nodule_keys, names, values)
+        return self.pid2nodules[pid]
+
+    def close_nodules(self, pid, zyx, max_dist=5.):
+        """
+        :return: characteristic names in the order of the first close nodule,
+                 (n close nodules, n names) matrix with their characteristics
+        """
+        centroids, nodule_keys, names, values = self.load(pid)
+        dist = np.sqrt(np.sum((centroids - np.asarray(zyx[:3], dtype='float64')) ** 2, axis=1))
+        close = np.flatnonzero(dist < max_dist)
+        if len(close) == 0:
+            return [], np.zeros((0, 0))
+        close_names = nodule_keys[close[0]]
+        return close_names, values[close][:, [names.index(n) for n in close_names]]
+
+
 def read_labels(file_path):
     id2labels = {}
     train_csv = open(file_path)
@@ -243,33 +503,149 @@ def read_test_labels(file_path):
     return id2labels
 
 
+LUNA_PROPERTIES = ['calcification', 'internalStructure', 'lobulation', 'malignancy', 'margin',
+                   'sphericity', 'spiculation', 'subtlety', 'texture']
+
+# bump when the layout of the cached luna tables changes
+LUNA_TABLE_CACHE_VERSION = 1
+
+
+class LunaTable(object):
+    """
+    Columnar LUNA annotation table, a structured array with the rows grouped by seriesuid.
+    It replaces the dict of lists returned by the csv readers: table[pid] is a zero-copy
+    (n, 4) view of the z, y, x, d columns of the patient, empty for unknown pids.
+    """
+
+    def __init__(self, rows, pid2range):
+        self.rows = rows
+        self.zyxd = rows['zyxd']
+        self.pid2range = pid2range
+
+    def __getitem__(self, pid):
+        start, stop = self.pid2range.get(pid, (0, 0))
+        return self.zyxd[start:stop]
+
+    def __contains__(self, pid):
+        return pid in self.pid2range
+
+    def __iter__(self):
+        return iter(self.pid2range)
+
+    def __len__(self):
+        return len(self.pid2range)
+
+    def get(self, pid, default=None):
+        return self[pid] if pid in self.pid2range else default
+
+    def keys(self):
+        return self.pid2range.keys()
+
+    def iterkeys(self):
+        return self.pid2range.iterkeys()
+
+    def iteritems(self):
+        for pid in self.pid2range:
+            yield pid, self[pid]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [self[pid] for pid in self.pid2range]
+
+    def rows_of(self, pid):
+        """
+        :return: view of the full structured rows of the patient
+        """
+        start, stop = self.pid2range.get(pid, (0, 0))
+        return self.rows[start:stop]
+
+
+def parse_luna_csv(file_path, n_extra_columns=0, keep_row=None):
+    """
+    Parses a LUNA csv with columns seriesuid, x, y, z, d followed by n_extra_columns floats.
+    :param keep_row: optional filter, maps the (n, 4) z, y, x, d columns to a boolean mask
+    :return: LunaTable with the rows of each seriesuid in csv order
+    """
+    with open(file_path) as f:
+        header = f.readline()
+        lines = [l for l in f.read().splitlines() if l]
+    n_columns = len(header.split(','))
+    fields = ','.join(lines).split(',')
+    pids = fields[0::n_columns]
+    values = np.array([fields[i::n_columns] for i in xrange(1, 5 + n_extra_columns)], dtype='float64').T
+    zyxd = values[:, [2, 1, 0, 3]]
+
+    dtype = [('pid', 'S64'), ('zyxd', 'float64', (4,))]
+    if n_extra_columns:
+        dtype.append(('extra', 'float64', (n_extra_columns,)))
+    rows = np.empty(len(pids), dtype=dtype)
+    rows['pid'] = pids
+    rows['zyxd'] = zyxd
+    if n_extra_columns:
+        rows['extra'] = values[:, 4:]
+    if keep_row is not None:
+        rows = rows[keep_row(rows['zyxd'])]
+    # stable sort keeps the csv order within a patient, sorting integer codes of the pids is much faster
+    pid2code = dict((pid, code) for code, pid in enumerate(sorted(set(rows['pid']))))
+    codes = np.array([pid2code[pid] for pid in rows['pid']], dtype='int64')
+    rows = rows[np.argsort(codes, kind='mergesort')]
+    return LunaTable(rows, luna_table_ranges(rows['pid']))
+
+
+def luna_table_ranges(pids):
+    """
+    :param pids: sorted seriesuid column
+    :return: dict of pid to the (start, stop) of its rows
+    """
+    pid2range = {}
+    if len(pids):
+        starts = np.append(0, np.flatnonzero(pids[1:] != pids[:-1]) + 1)
+        stops = np.append(starts[1:], len(pids))
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            pid2range[str(pids[start])] = (start, stop)
+    return pid2range
+
+
+def load_luna_table(file_path, kind, parse_fun):
+    """
+    Loads a parsed LUNA csv from its binary cache next to the csv, the cache is
+    rebuilt when the modification time or the size of the csv changed.
+    """
+    cache_path = '%s.%s.npz' % (file_path, kind)
+    stat = os.stat(file_path)
+    source = np.array([LUNA_TABLE_CACHE_VERSION, stat.st_mtime, stat.st_size], dtype='float64')
+    if os.path.isfile(cache_path):
+        try:
+            with np.load(cache_path) as cache:
+                if np.array_equal(cache['source'], source):
+                    rows = cache['rows']
+                    return LunaTable(rows, luna_table_ranges(rows['pid']))
+        except (IOError, ValueError, KeyError):
+            pass
+
+    table = parse_fun(file_path)
+    # every process writes its own temporary file, the rename replaces the cache atomically
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, source=source, rows=table.rows)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+        print 'WARNING: could not cache', file_path, e
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+    return table
+
+
 def read_luna_annotations(file_path):
-    id2xyzd = defaultdict(list)
-    train_csv = open(file_path)
-    lines = train_csv.readlines()
-    i = 0
-    for item in lines:
-        if i == 0:
-            i = 1
-            continue
-        id, x, y, z, d = item.replace('\n', '').split(',')
-        id2xyzd[id].append([float(z), float(y), float(x), float(d)])
-    return id2xyzd
+    return load_luna_table(file_path, 'annotations', parse_luna_csv)
 
 
 def read_luna_negative_candidates(file_path):
-    id2xyzd = defaultdict(list)
-    train_csv = open(file_path)
-    lines = train_csv.readlines()
-    i = 0
-    for item in lines:
-        if i == 0:
-            i = 1
-            continue
-        id, x, y, z, d = item.replace('\n', '').split(',')
-        if float(d) == 0:
-            id2xyzd[id].append([float(z), float(y), float(x), float(d)])
-    return id2xyzd
+    return load_luna_table(file_path, 'negative_candidates',
+                           lambda path: parse_luna_csv(path, keep_row=lambda zyxd: zyxd[:, 3] == 0))
 
 
 def write_submission(pid2prediction, submission_path):
@@ -352,33 +728,24 @@ def log_loss(y_real, y_pred, eps=1e-15):
     return - np.average(losses)
 
 
+def read_luna_properties_table(file_path):
+    """
+    :return: LunaTable with the LUNA_PROPERTIES in the 'extra' column of its rows
+    """
+    return load_luna_table(file_path, 'properties',
+                           lambda path: parse_luna_csv(path, n_extra_columns=len(LUNA_PROPERTIES)))
+
+
 def read_luna_properties(file_path):
+    """
+    :return: dict of lists of [z, y, x, d, properties_dict], built from the cached table
+    """
+    table = read_luna_properties_table(file_path)
     id2xyzp = defaultdict(list)
-    train_csv = open(file_path)
-    lines = train_csv.readlines()
-    i = 0
-    for item in lines:
-        if i == 0:
-            i = 1
-            continue
-        annotation = item.replace('\n', '').split(',')
-        id = annotation[0]
-        x = float(annotation[1])
-        y = float(annotation[2])
-        z = float(annotation[3])
-        d = float(annotation[4])
-        properties_dict = {
-            'diameter': d,
-            'calcification': float(annotation[5]),
-            'internalStructure': float(annotation[6]),
-            'lobulation': float(annotation[7]),
-            'malignancy': float(annotation[8]),
-            'margin': float(annotation[9]),
-            'sphericity': float(annotation[10]),
-            'spiculation': float(annotation[11]),
-            'subtlety': float(annotation[12]),
-            'texture': float(annotation[13]),
-        }
-
-        id2xyzp[id].append([z, y, x, d, properties_dict])
+    for pid in table:
+        for row in table.rows_of(pid):
+            z, y, x, d = row['zyxd'].tolist()
+            properties_dict = dict(zip(LUNA_PROPERTIES, row['extra'].tolist()))
+            properties_dict['diameter'] = d
+            id2xyzp[pid].append([z, y, x, d, properties_dict])
     return id2xyzp
@@ -0,0 +1,70 @@
+import collections
+import threading
+import numpy as np
+
+
+class VolumeCache(object):
+    """
+    LRU cache of scans bounded by the total number of bytes of the cached arrays.
+    It is thread-safe, so it can be shared with the buffering producer thread.
+    Cached arrays are shared between all readers and are therefore made read-only,
+    values too large to be cached are returned as they are.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, load_fun):
+        """
+        :param load_fun: called without arguments to load the value on a miss
+        :return: the cached value, or the freshly loaded one
+        """
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries.pop(key)
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # load outside of the lock, so readers of other scans are not blocked
+        value = load_fun()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        arrays = [x for x in (value if isinstance(value, tuple) else (value,)) if isinstance(x, np.ndarray)]
+        nbytes = sum(x.nbytes for x in arrays)
+        if nbytes > self.max_bytes:
+            return
+        for x in arrays:
+            x.flags.writeable = False
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            while self._entries and self.nbytes + nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'nbytes': self.nbytes}
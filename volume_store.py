@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import utils
+
+
+class VolumeStore(object):
+    """
+    On-disk store of HU volumes, one contiguous int16 .npy file per patient
+    plus a small .pkl with the pixel spacing and metadata.
+    Volumes are opened with np.load(mmap_mode='r'), so the OS page cache
+    is shared between all processes reading the same store.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        utils.auto_make_dir(store_path)
+
+    def volume_path(self, pid):
+        return self.store_path + '/' + pid + '.npy'
+
+    def metadata_path(self, pid):
+        return self.store_path + '/' + pid + '.pkl'
+
+    def __contains__(self, pid):
+        # metadata is written last, so its presence marks a complete entry
+        return os.path.isfile(self.metadata_path(pid))
+
+    def pids(self):
+        return sorted(f[:-len('.pkl')] for f in os.listdir(self.store_path) if f.endswith('.pkl'))
+
+    def write_scan(self, pid, img, pixel_spacing, metadata=None):
+        """
+        Writes a HU volume to the store. The volume is rounded to int16,
+        which is lossless for CT data with an integer rescale slope.
+        """
+        volume = np.ascontiguousarray(np.rint(img), dtype='int16')
+        md = dict(metadata) if metadata else {}
+        md['pid'] = pid
+        md['shape'] = volume.shape
+        md['pixel_spacing'] = np.array(pixel_spacing)
+
+        # write to temporary files first so readers never see partial entries
+        tmp_volume_path = self.volume_path(pid) + '.tmp'
+        with open(tmp_volume_path, 'wb') as f:
+            np.save(f, volume)
+        os.rename(tmp_volume_path, self.volume_path(pid))
+        tmp_metadata_path = self.metadata_path(pid) + '.tmp'
+        utils.save_pkl(md, tmp_metadata_path)
+        os.rename(tmp_metadata_path, self.metadata_path(pid))
+
+    def read_metadata(self, pid):
+        return utils.load_pkl(self.metadata_path(pid))
+
+    def read_scan(self, pid, dtype='float32'):
+        """
+        Drop-in replacement for utils_lung.read_dicom_scan.
+        :param dtype: dtype of the returned volume, None returns the read-only int16 memmap
+        :return: volume, pixel_spacing
+        """
+        metadata = self.read_metadata(pid)
+        img = np.load(self.volume_path(pid), mmap_mode='r')
+        if dtype is not None:
+            img = np.asarray(img, dtype=dtype)
+        return img, metadata['pixel_spacing']
+
+    def read_scan_roi(self, pid, roi_fun, dtype='float32', fill_value=-1000.):
+        """
+        Partial read, only the pages of the memmap covering the roi are touched.
+        Volumes are stored z-major, so a range of slices is one contiguous block.
+        :param roi_fun: maps (scan shape, pixel spacing) to the voxel (start, stop) of the roi and
+                        the (n, 2, 3) boxes in it that are read, None reads the whole roi
+        :param fill_value: value of the voxels of the roi outside the boxes
+        :return: volume of the roi, pixel spacing, start of the roi
+        """
+        metadata = self.read_metadata(pid)
+        pixel_spacing = metadata['pixel_spacing']
+        start, stop, boxes = roi_fun(metadata['shape'], pixel_spacing)
+        img = np.load(self.volume_path(pid), mmap_mode='r')
+        if boxes is None:
+            img = np.array(img[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]], dtype=dtype)
+            return img, pixel_spacing, start
+        roi = np.full(np.maximum(stop - start, 0), fill_value, dtype=dtype)
+        for box_start, box_stop in boxes:
+            (z0, y0, x0), (z1, y1, x1) = box_start - start, box_stop - start
+            roi[z0:z1, y0:y1, x0:x1] = img[box_start[0]:box_stop[0], box_start[1]:box_stop[1],
+                                           box_start[2]:box_stop[2]]
+        return roi, pixel_spacing, start